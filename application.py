@@ -25,13 +25,12 @@ from random import Random
 import string
 import redis
 import utils
-import hashlib
-from utils import deploy, config
-from utils.log import RedisHandler
+from utils import deploy, config, pool, metrics
+from utils.log import RedisHandler, RateLimitFilter
 import queue
 import schema
 import messages
-from decorators import admin_required, login_required, api_key_required
+from decorators import admin_required, login_required, api_key_required, get_current_user
 import mq
 
 app = Flask(__name__)
@@ -44,6 +43,8 @@ babel = Babel(app)
 # redis handler
 redis_handler = RedisHandler()
 redis_handler.setLevel(logging.DEBUG)
+log_filter = RateLimitFilter()
+redis_handler.addFilter(log_filter)
 app.logger.addHandler(redis_handler)
 
 api_log = config.get_logger('api')
@@ -67,15 +68,17 @@ def teardown_request(exception):
     pass
 
 def get_db_connection():
-    return redis.Redis(host=app.config['DB_HOST'], port=app.config['DB_PORT'], \
-        db=app.config['DB_NAME'], password=app.config['DB_PASSWORD'])
+    return redis.Redis(connection_pool=pool.get_connection_pool())
+
+def get_blocking_db_connection():
+    return redis.Redis(connection_pool=pool.get_blocking_connection_pool())
 
 @babel.localeselector
 def get_locale():
     # if a user is logged in, use the locale from the account
     if session.has_key('user'):
-        user = json.loads(g.db.get(schema.USER_KEY.format(session['user'])))
-        if user.has_key('locale'):
+        user = get_current_user()
+        if user and user.has_key('locale'):
             return user['locale']
     # otherwise try to guess the language from the user accept
     # header the browser sends
@@ -86,15 +89,17 @@ def index():
     if 'auth_token' in session:
         ctx = {}
         try:
-            applications = utils.get_node_applications()
+            applications = utils.get_application_configs(utils.get_node_applications(), \
+                ['version', 'instances', 'runtime'])
             apps = []
-            for app in applications:
-                json_data = json.loads(utils.get_application_config(app))
+            for app, app_config in applications.iteritems():
+                if not app_config:
+                    continue
                 app_data = {
                     'name': app,
-                    'version': json_data['version'],
-                    'instances': json_data['instances'][settings.NODE_NAME],
-                    'runtime': json_data['runtime'],
+                    'version': app_config.get('version'),
+                    'instances': app_config.get('instances', {}).get(settings.NODE_NAME, []),
+                    'runtime': app_config.get('runtime'),
                 }
                 apps.append(app_data)
             ctx = {
@@ -132,6 +137,7 @@ def login():
                 session['role'] = user_data['role']
                 session['auth_token'] = auth_token
                 g.db.set(user_key, json.dumps(user_data))
+                utils.user_cache.invalidate_user(username)
         else:
             flash(messages.INVALID_USERNAME_PASSWORD, 'error')
     return redirect(url_for('index'))
@@ -148,6 +154,7 @@ def logout():
         user_data = json.loads(user)
         user_data['auth_token'] = None
         g.db.set(user_key, json.dumps(user_data))
+        utils.user_cache.invalidate_user(session['user'])
         session.pop('user')
         flash(messages.LOGGED_OUT)
     return redirect(url_for('index'))
@@ -157,7 +164,7 @@ def logout():
 def account():
     if 'user' in session:
         user_key = schema.USER_KEY.format(session['user'])
-        account = json.loads(utils.get_user(session['user']))
+        account = get_current_user()
         if request.method == 'GET':
             ctx = {
                 'account': account,
@@ -168,14 +175,15 @@ def account():
             for k in request.form:
                 account[k] = request.form[k]
             g.db.set(user_key, json.dumps(account))
+            utils.user_cache.invalidate_user(session['user'])
             flash(messages.ACCOUNT_UPDATED, 'success')
     return redirect(url_for('account'))
 
 @app.route("/accounts/")
 @admin_required
 def accounts():
-    users = [json.loads(g.db.get(x)) for x in g.db.keys(schema.USER_KEY.format('*'))]
-    roles = [json.loads(g.db.get(x)) for x in g.db.keys(schema.ROLE_KEY.format('*'))]
+    users = [json.loads(x) for x in utils.get_users()]
+    roles = [json.loads(x) for x in utils.get_roles()]
     ctx = {
         'users': users,
         'roles': roles,
@@ -238,42 +246,31 @@ def delete_role(rolename):
 @app.route("/tasks/")
 @admin_required
 def tasks():
-    tasks = []
-    for t in g.db.keys('{0}:*'.format(app.config['TASK_QUEUE_NAME'])):
-        tasks.append(json.loads(g.db.get(t)))
-    num_of_queued = g.db.llen(app.config['TASK_QUEUE_NAME'])
-    if num_of_queued > 0:
-        for i in range(num_of_queued):
-            # generate unique hash for key -- used to delete
-            task_data = g.db.lindex(app.config['TASK_QUEUE_NAME'], i)
-            sha = hashlib.sha256(task_data)
-            task_hash = sha.hexdigest()
-            data = {}
-            data['task'] = task_data
-            data['task_id'] = task_hash
-            data['date'] = None
-            data['status'] = 'new'
-            tasks.append(data)
+    try:
+        page = max(0, int(request.args.get('page', 0)))
+    except ValueError:
+        page = 0
+    page_size = app.config['TASK_PAGE_SIZE']
+    offset = page * page_size
+    tasks = [json.loads(x) for x in utils.get_pending_tasks(offset, page_size)]
+    tasks.extend([json.loads(x) for x in \
+        utils.get_task_results(offset, page_size)])
+    more = utils.get_pending_task_count() > offset + page_size or \
+        len(utils.get_task_results(offset + page_size, 1)) > 0
     ctx = {
         'tasks': tasks,
+        'lanes': utils.get_queue_depths(),
+        'page': page,
+        'more': more,
     }
     return render_template("tasks.html", **ctx)
 
 @app.route("/tasks/delete/<task_id>/")
 @admin_required
 def delete_task(task_id=None):
-    # delete 'complete' key
-    key = '{0}:{1}'.format(app.config['TASK_QUEUE_NAME'], task_id)
-    if task_id and g.db.get(key):
-        g.db.delete(key)
-    else: # task is 'new'
-        # generate hash to find key
-        for k in range(g.db.llen(app.config['TASK_QUEUE_NAME'])):
-            task_data = g.db.lindex(app.config['TASK_QUEUE_NAME'], k)
-            sha = hashlib.sha256(task_data)
-            task_hash = sha.hexdigest()
-            if task_hash == task_id:
-                g.db.lrem(app.config['TASK_QUEUE_NAME'], task_data)
+    # pending tasks are cancelled, finished ones removed
+    if not utils.cancel_task(task_id):
+        utils.delete_task_result(task_id)
     log.info('{0} deleted task {1}'.format(session['user'], task_id))
     flash('Task deleted...', 'success')
     return redirect(url_for('tasks'))
@@ -281,29 +278,35 @@ def delete_task(task_id=None):
 @app.route("/tasks/deleteall/")
 @admin_required
 def delete_all_tasks():
-    g.db.delete(app.config['TASK_QUEUE_NAME'])
-    for k in g.db.keys('{0}:*'.format(app.config['TASK_QUEUE_NAME'])):
-        g.db.delete(k)
+    utils.delete_pending_tasks()
+    utils.delete_task_results()
     flash('All tasks removed...')
     return redirect(url_for('tasks'))
 
+def _get_log_filters():
+    filters = {}
+    for k in ('cursor', 'limit', 'level', 'category', 'start', 'end'):
+        if request.args.get(k):
+            filters[k] = request.args.get(k)
+    return filters
+
 @app.route("/logs/")
 @admin_required
 def logs():
-    logs = []
-    log_key = schema.LOG_KEY.format('*')
-    for l in g.db.keys(log_key):
-        logs.append(json.loads(g.db.get(l)))
+    filters = _get_log_filters()
+    logs, cursor = utils.get_logs(**filters)
+    filters.pop('cursor', None)
     ctx = {
         'logs': logs,
+        'cursor': cursor,
+        'filters': filters,
     }
     return render_template("logs.html", **ctx)
 
 @app.route("/logs/clear/")
 @admin_required
 def clear_logs():
-    for k in g.db.keys(schema.LOG_KEY.format('*')):
-        g.db.delete(k)
+    utils.clear_logs()
     flash('Logs cleared...')
     return redirect(url_for('logs'))
 
@@ -319,6 +322,18 @@ def api(action=None):
         action = action.lower()
         if action == 'version':
             return jsonify({'name': app.config['APP_NAME'], 'version': app.config['VERSION']})
+        elif action == 'poolstats':
+            return jsonify(pool.get_pool_stats())
+        elif action == 'cachestats':
+            return jsonify(utils.app_config_cache.get_stats())
+        elif action == 'logstats':
+            data = redis_handler.get_stats()
+            data['suppressed'] = log_filter.get_stats()
+            return jsonify(data)
+        elif action == 'ports':
+            return jsonify(utils.get_port_occupancy())
+        elif action == 'applications':
+            data = utils.get_application_configs(utils.get_node_applications())
         elif action.lower() == 'deploy':
             data = {}
             app_name = None
@@ -327,25 +342,36 @@ def api(action=None):
             f = request.files['package']
             pkg_name = tempfile.mktemp()
             f.save(pkg_name)
-            data['task_id'] = deploy.deploy_app.delay(app_name, pkg_name).key
+            data['task_id'] = deploy.deploy_app.delay(app_name, pkg_name, \
+                priority=request.form.get('priority')).key
         elif action == 'restart':
             data = {}
             if 'application' not in request.form:
                 raise NameError('You must specify an application')
             app_name = request.form['application']
-            data['task_id'] = deploy.restart_application.delay(app_name).key
+            data['task_id'] = deploy.restart_application.delay(app_name, \
+                priority=request.form.get('priority')).key
         elif action == 'stop':
             data = {}
             if 'application' not in request.form:
                 raise NameError('You must specify an application')
             app_name = request.form['application']
-            data['task_id'] = deploy.stop_application.delay(app_name).key
+            data['task_id'] = deploy.stop_application.delay(app_name, \
+                priority=request.form.get('priority')).key
         elif action == 'remove':
             data = {}
             if 'application' not in request.form:
                 raise NameError('You must specify an application')
             app_name = request.form['application']
-            data['task_id'] = deploy.remove_application.delay(app_name).key
+            data['task_id'] = deploy.remove_application.delay(app_name, \
+                priority=request.form.get('priority')).key
+        elif action == 'rollback':
+            data = {}
+            if 'application' not in request.form:
+                raise NameError('You must specify an application')
+            app_name = request.form['application']
+            data['task_id'] = deploy.rollback_application.delay(app_name, \
+                request.form.get('release'), priority=request.form.get('priority')).key
         else:
             print('Unknown action: {0}'.format(action))
             data['status'] = 'error'
@@ -358,11 +384,83 @@ def api(action=None):
 @api_key_required
 def api_task(task_id=None):
     try:
-        task = utils.get_task(task_id)
+        # ?wait=<seconds> blocks until the task has finished
+        wait = max(0, min(float(request.args.get('wait', 0)), app.config['TASK_WAIT_MAX']))
+        task = utils.wait_for_task(task_id, wait)
+        # ?output=1 streams the full (uncompressed) output instead of the summary
+        if task and request.args.get('output'):
+            return Response(utils.iter_task_output(task_id), mimetype='text/plain')
         try:
             data = json.loads(task)
         except Exception, e:
             data = {'status': 'error', 'result': 'invalid task'}
+    except pool.PoolExhaustedError, e:
+        # too many waiting clients -- try again later
+        rv = jsonify({'status': 'error', 'result': str(e)})
+        rv.status_code = 503
+        return rv
+    except Exception, e:
+        data = {'status': 'error', 'result': str(e)}
+    return jsonify(data)
+
+@app.route("/api/task/<task_id>/stream")
+@api_key_required
+def api_task_stream(task_id=None):
+    """
+    Relays the progress events of a task as server-sent events until it
+    has finished
+
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id') or '0'
+    keepalive = app.config['TASK_STREAM_KEEPALIVE']
+    try:
+        # one blocking connection for the whole stream
+        db = pool.reserve_blocking_connection()
+    except pool.PoolExhaustedError, e:
+        rv = jsonify({'status': 'error', 'result': str(e)})
+        rv.status_code = 503
+        return rv
+    def stream(last_id):
+        try:
+            while True:
+                events = utils.get_task_events(task_id, last_id, keepalive, db)
+                for event_id, event in events:
+                    last_id = event_id
+                    yield 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(event_id, \
+                        event.get('type'), json.dumps(event))
+                    if event.get('type') == 'done':
+                        return
+                if not events:
+                    # finished without a done event (cancelled, superseded, expired)
+                    task = utils.get_task(task_id)
+                    status = json.loads(task).get('status') if task else None
+                    if status not in ('new', 'running', 'retrying'):
+                        yield 'event: done\ndata: {0}\n\n'.format(json.dumps( \
+                            {'type': 'done', 'status': status}))
+                        return
+                    yield ': keepalive\n\n'
+        finally:
+            db.connection_pool.close()
+    rv = Response(stream(last_id), mimetype='text/event-stream', \
+        headers={'Cache-Control': 'no-cache'})
+    rv.call_on_close(db.connection_pool.close)
+    return rv
+
+@app.route("/api/metrics")
+@api_key_required
+def api_metrics():
+    """
+    Queue and task metrics in the Prometheus text format
+
+    """
+    return Response(metrics.get_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/api/logs", methods=['GET'])
+@api_key_required
+def api_logs():
+    try:
+        logs, cursor = utils.get_logs(**_get_log_filters())
+        data = {'logs': logs, 'cursor': cursor}
     except Exception, e:
         data = {'status': 'error', 'result': str(e)}
     return jsonify(data)
@@ -502,12 +600,19 @@ if __name__=="__main__":
     op.add_option('--create-user', dest='create_user', action='store_true', default=False, help='Create/update user')
     op.add_option('--enable-user', dest='enable_user', action='store_true', default=False, help='Enable user')
     op.add_option('--disable-user', dest='disable_user', action='store_true', default=False, help='Disable user')
+    op.add_option('--rebuild-indexes', dest='rebuild_indexes', action='store_true', default=False, help='Rebuild record indexes')
     op.add_option('--host', dest='host', default='localhost', help='Host to listen on for the Werkzeug debug server')
     op.add_option('--port', dest='port', type=int, default=5000, help='Port to run Werkzeug debug server')
     opts, args = op.parse_args()
 
     # check app dirs
     check_app_dirs()
+    # move old port reservations, application configs and logs to the new
+    # layout and index records stored before the indexes
+    utils.migrate_legacy_ports()
+    utils.migrate_legacy_application_configs()
+    utils.migrate_legacy_logs()
+    utils.migrate_legacy_indexes()
     if opts.create_user:
         create_user()
         sys.exit(0)
@@ -517,6 +622,9 @@ if __name__=="__main__":
     if opts.disable_user:
         toggle_user(False)
         sys.exit(0)
+    if opts.rebuild_indexes:
+        utils.rebuild_indexes()
+        sys.exit(0)
     if opts.port:
         port = opts.port
         # override port
@@ -529,6 +637,7 @@ if __name__=="__main__":
     # start mq
     mq.main()
     # run app
-    app.run(host=opts.host, port=int(port))
+    # threaded -- long polls and event streams block their request
+    app.run(host=opts.host, port=int(port), threaded=True)
 
 
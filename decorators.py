@@ -6,6 +6,26 @@ from flask import json
 from flask import jsonify
 import schema
 import messages
+import utils
+
+def get_current_user():
+    """
+    Returns the logged in user record
+
+    Loaded at most once per request (and shared between requests with the
+    same auth token for ``USER_CACHE_TTL`` seconds)
+
+    """
+    if getattr(g, 'user', None) is None and 'user' in session:
+        auth_token = session.get('auth_token')
+        user = utils.user_cache.get(auth_token)
+        if user is None:
+            user = g.db.get(schema.USER_KEY.format(session['user']))
+            if user:
+                user = json.loads(user)
+                utils.user_cache.set(auth_token, user)
+        g.user = user
+    return getattr(g, 'user', None)
 
 def admin_required(f):
     @wraps(f)
@@ -13,10 +33,8 @@ def admin_required(f):
         if 'user' not in session or 'auth_token' not in session:
             flash(messages.ACCESS_DENIED, 'error')
             return redirect(url_for('index'))
-        user_key = schema.USER_KEY.format(session['user'])
-        user = g.db.get(user_key)
-        user_data = json.loads(user)
-        if 'role' not in user_data or user_data['role'].lower() != 'admin':
+        user_data = get_current_user()
+        if not user_data or 'role' not in user_data or user_data['role'].lower() != 'admin':
             flash(messages.ACCESS_DENIED, 'error')
             return redirect(url_for('index'))
         return f(*args, **kwargs)
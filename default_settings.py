@@ -21,11 +21,32 @@ DB_PORT = 6379
 DB_NAME = 0
 DB_USER = '<DBUSER>'
 DB_PASSWORD = '<DBPASS>'
+DB_MAX_CONNECTIONS = 50
+# long polls and event streams (past this the API answers 503)
+DB_MAX_BLOCKING_CONNECTIONS = 20
+DB_HEALTH_CHECK_INTERVAL = 30 # in seconds
 LOCALES = ( 
     ('en', lazy_gettext(u'English')),
     ('fr', lazy_gettext(u'French')),
 )
 LOG_LEVEL = logging.DEBUG
+# redis log handler buffering
+LOG_BATCH_SIZE = 100
+LOG_BUFFER_SIZE = 10000
+LOG_DROP_POLICY = 'oldest' # oldest or newest
+LOG_FLUSH_INTERVAL = 1 # in seconds
+# redis log store
+LOG_MAX_AGE = 604800 # in seconds
+LOG_MAX_LENGTH = 10000
+LOG_PAGE_SIZE = 100
+# per category (logger name) limits for the redis log handler
+#   sample: keep 1 in N DEBUG records
+#   rate/burst: token bucket for DEBUG and INFO records (per second/bucket size)
+# WARN and ERROR records are never dropped
+LOG_LIMITS = {
+    'default': {'sample': 1, 'rate': 100, 'burst': 500},
+    'install_virtualenv': {'sample': 10, 'rate': 20, 'burst': 100},
+}
 NODE_NAME = os.uname()[1]
 NODE_ADDRESS = '127.0.0.1'
 NODE_PORT = 5000
@@ -34,6 +55,50 @@ SECRET_KEY = "<SECRET_KEY>"
 # queue settings
 TASK_QUEUE_NAME = 'queue:{0}'.format(NODE_NAME)
 TASK_QUEUE_KEY_TTL = 86400
+TASK_PAGE_SIZE = 50
+# task results longer than TASK_RESULT_SUMMARY_SIZE keep a summary (strings
+# cut at that length) in the result; the full output is stored compressed in
+# chunks of TASK_RESULT_CHUNK_SIZE bytes and cut at TASK_RESULT_MAX_SIZE
+TASK_RESULT_SUMMARY_SIZE = 256 # in characters
+TASK_RESULT_CHUNK_SIZE = 65536 # in bytes
+TASK_RESULT_MAX_SIZE = 4194304 # in bytes
+# progress events kept per task and the output sent with a step event
+TASK_EVENTS_MAX_LENGTH = 1000
+TASK_EVENT_OUTPUT_SIZE = 4096 # in characters
+# seconds between keepalives on /api/task/<id>/stream
+TASK_STREAM_KEEPALIVE = 15
+# histogram buckets for task wait and run times (/api/metrics)
+METRICS_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800] # in seconds
+# longest a client can block waiting for a task (/api/task/<id>?wait=)
+TASK_WAIT_MAX = 60 # in seconds
+# priority lanes, drained highest first
+QUEUE_LANES = ['high', 'default', 'low']
+QUEUE_DEFAULT_LANE = 'default'
+# every Nth task a worker takes starts from a lower lane so they keep moving
+QUEUE_LANE_FAIRNESS = 10
+# worker processes (1 runs tasks in the queue process, 0 uses the number of cpus)
+QUEUE_CONCURRENCY = 1
+QUEUE_POLL_TIMEOUT = 5 # in seconds
+QUEUE_SUPERVISOR_INTERVAL = 1 # in seconds
+QUEUE_WORKER_MAX_MEMORY = 512 # in MB
+QUEUE_WORKER_MAX_TASKS = 1000
+# seconds a worker lease lives without a heartbeat before its tasks are re-queued
+QUEUE_LEASE_TTL = 30
+# times a task is re-queued after its worker was lost before it is failed
+QUEUE_MAX_REDELIVERIES = 3
+# failed tasks with retries are re-run after a random delay of up to
+# QUEUE_RETRY_BACKOFF * 2 ** retry seconds (capped at QUEUE_RETRY_MAX_DELAY)
+QUEUE_RETRY_BACKOFF = 2 # in seconds
+QUEUE_RETRY_MAX_DELAY = 300 # in seconds
+# times a deploy is retried after a failed clone or dependency install
+DEPLOY_MAX_RETRIES = 3
+# most delayed tasks moved onto the lanes per scheduler pass
+QUEUE_SCHEDULE_BATCH = 1000
+# application config cache (invalidated via CONFIG_CHANNEL)
+APP_CONFIG_CACHE = True
+APP_CONFIG_CACHE_TTL = 300
+# seconds to cache the logged in user by auth token (0 disables)
+USER_CACHE_TTL = 5
 # app version
 VERSION = '0.1'
 
@@ -42,14 +107,28 @@ ROOT_DIR = '/var/tmp'
 APP_MIN_PORT = 15000
 APP_MAX_PORT = 40000
 APPLICATION_BASE_DIR = os.path.join(ROOT_DIR, 'apps')
+RELEASES_KEEP = 5 # releases kept per application for rollbacks
 APPLICATION_USER = 'www-data'
 APPLICATION_GROUP = 'www-data'
 APPLICATION_LOG_DIR = os.path.join(ROOT_DIR, 'logs')
 APPLICATION_STATE_DIR = os.path.join(ROOT_DIR, 'state')
 CLIENT_CHANNEL = 'client'
+CONFIG_CHANNEL = 'config'
 HEARTBEAT_INTERVAL = 10 # in seconds
 MASTER_CHANNEL = 'master'
 VIRTUALENV_BASE_DIR = os.path.join(ROOT_DIR, 've')
+# extracted packages by sha256 (least recently used evicted past the limits)
+PACKAGE_CACHE_DIR = os.path.join(ROOT_DIR, 'packages')
+PACKAGE_CACHE_MAX_SIZE = 1073741824 # in bytes
+PACKAGE_CACHE_MAX_ENTRIES = 50
+# virtualenvs by runtime and dependency fingerprint (kept unused for a while
+# for rollbacks)
+VIRTUALENV_CACHE_DIR = os.path.join(ROOT_DIR, 've-cache')
+VIRTUALENV_CACHE_TTL = 604800 # in seconds
+# wheels shared by every virtualenv on the node; with PIP_OFFLINE installs
+# only use the wheelhouse (no index)
+WHEELHOUSE_DIR = os.path.join(ROOT_DIR, 'wheelhouse')
+PIP_OFFLINE = False
 SUPERVISOR_CONF_DIR = os.path.join(ROOT_DIR, 'supervisor')
 WEBSERVER_CONF_DIR = os.path.join(ROOT_DIR, 'nginx')
 
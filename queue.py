@@ -1,11 +1,24 @@
 #!/usr/bin/env
 from flask import current_app
 from flask import json
+from functools import wraps
 import application
+import hashlib
+import math
+import multiprocessing
+import os
 import pickle
+import random
+import resource
+import signal
+import sys
+import threading
 import uuid
 import time
 import settings
+import schema
+import utils
+from utils import metrics
 
 class DelayedResult(object):
     def __init__(self, key):
@@ -13,58 +26,534 @@ class DelayedResult(object):
         self.key = key
         self._rv = None
 
+    def _load(self, task=None):
+        data = json.loads(task) if task else {}
+        if data.get('status') == 'superseded':
+            # follow the task that replaced this one
+            self.key = data.get('result')
+        elif data.get('status') in ('complete', 'error'):
+            rv = data.get('result')
+            if data.get('chunks'):
+                rv = utils.get_task_output(self.key)
+            try:
+                # dict results are stored as json
+                rv = json.loads(rv) if rv.startswith('{') else rv
+            except (AttributeError, ValueError):
+                pass
+            self._rv = rv
+        return self._rv
+
     @property
     def return_value(self):
-        if self._rv is None:
-            rv = self.db.get('{0}:{1}'.format(self.key))
-            if rv is not None:
-                self._rv = pickle.loads(rv)
+        return self.wait(0)
+
+    def wait(self, timeout=settings.TASK_WAIT_MAX):
+        """
+        Blocks until the task has finished and returns its return value
+        (``None`` if it has not finished within ``timeout`` seconds)
+
+        """
+        end = time.time() + (timeout or 0)
+        while self._rv is None:
+            key = self.key
+            self._load(utils.wait_for_task(key, max(0, end - time.time())))
+            if self.key == key:
+                break
         return self._rv
 
-def task(f):
+# cap on pending wake up signals (idle workers just find nothing to do)
+MAX_SIGNALS = 100
+# version of the queued task envelope
+ENVELOPE_VERSION = 1
+
+# registered tasks by name
+TASKS = {}
+
+class Retry(Exception):
+    """
+    Raised by a task to be run again later (counts against ``max_retries``)
+
+    :keyword countdown: (optional) Seconds to wait (default backoff)
+
+    """
+    def __init__(self, message=None, countdown=None):
+        Exception.__init__(self, message)
+        self.countdown = countdown
+
+# the task running in this process (for progress events)
+_context = threading.local()
+
+def emit_event(event_type=None, **kwargs):
+    """
+    Sends a progress event for the running task (does nothing outside a task)
+
+    Events are appended to the task's event stream -- the worker never
+    waits for the clients reading it.
+
+    """
+    task_id = getattr(_context, 'task_id', None)
+    if not task_id:
+        return None
+    event = {'type': event_type, 'date': time.time()}
+    event.update(kwargs)
+    try:
+        return utils.add_task_event(task_id, event)
+    except Exception, e:
+        # progress must never break the task
+        print('Task {0}: unable to send event: {1}'.format(task_id, e))
+        return None
+
+class step(object):
+    """
+    Reports a step of the running task as started and finished (or failed)
+    with its duration; output of a returned result dict is sent too
+
+    Use as a decorator (``@step('name')``) or a context manager.
+
+    """
+    def __init__(self, name=None):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        emit_event('step', step=self.name, status='started')
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        emit_event('step', step=self.name, status='failed' if exc_type else 'finished', \
+            duration=time.time() - self.start)
+        return False
+
+    def output(self, text=None):
+        size = settings.TASK_EVENT_OUTPUT_SIZE
+        if text:
+            emit_event('output', step=self.name, text=text[-size:], \
+                truncated=len(text) > size)
+
+    def __call__(self, f):
+        name = self.name or f.__name__
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with step(name) as s:
+                rv = f(*args, **kwargs)
+                if isinstance(rv, dict):
+                    for k, v in sorted((rv.get('output') or {}).items()):
+                        if isinstance(v, basestring):
+                            s.output('{0}: {1}'.format(k, v))
+                return rv
+        return decorated
+
+def task(f=None, priority=None, name=None, coalesce=False, supersede=False, \
+    max_retries=0):
+    """
+    Makes ``f`` a queued task -- ``f.delay(*args, **kwargs)`` queues a call
+
+    Use as ``@task`` or ``@task(priority='high')`` to set the default lane.
+    ``delay`` takes ``priority`` (lane), ``eta`` (timestamp), ``countdown``
+    (seconds) and ``max_retries`` keywords.  Arguments must be JSON
+    serializable.
+
+    :keyword priority: Default lane (one of ``QUEUE_LANES``)
+    :keyword name: Registered task name (default the function name)
+    :keyword coalesce: Calls with the same arguments as a pending call
+        return the pending task instead of queueing another one
+    :keyword supersede: A call for an application replaces a pending call
+        of the task for the same application
+    :keyword max_retries: Times a failing call is run again (with
+        exponential backoff and jitter)
+
+    """
+    if f is None:
+        return lambda f: task(f, priority, name, coalesce, supersede, max_retries)
+    task_name = name or f.__name__
     def delay(*args, **kwargs):
-        db = application.get_db_connection()
-        qkey = settings.TASK_QUEUE_NAME
+        lane = kwargs.pop('priority', None) or priority or settings.QUEUE_DEFAULT_LANE
+        eta = kwargs.pop('eta', None)
+        countdown = kwargs.pop('countdown', None)
+        retries = kwargs.pop('max_retries', None)
+        if countdown:
+            eta = time.time() + countdown
         task_id = str(uuid.uuid4())
-        key = '{0}:{1}'.format(qkey, task_id)
-        s = pickle.dumps((f, task_id, args, kwargs))
-        db.rpush(settings.TASK_QUEUE_NAME, s)
+        app_name = _get_app_name(args, kwargs)
+        key = _get_task_key(task_name, args, kwargs, app_name, coalesce, supersede)
+        data = schema.task(task_id, task_name, app_name, lane, key, eta)
+        # workers take from the tail (RPOPLPUSH)
+        s = encode_task(task_name, task_id, args, kwargs, lane, data['date'], key=key, \
+            eta=eta, max_retries=retries)
+        task_id, superseded = utils.add_pending_task(s, data, key, supersede, MAX_SIGNALS)
         return DelayedResult(task_id)
     f.delay = delay
+    f.priority = priority
+    f.max_retries = max_retries
+    f.task_name = task_name
+    TASKS[task_name] = f
     return f
 
-def queue_daemon(app, rv_ttl=settings.TASK_QUEUE_KEY_TTL):
+def _get_app_name(args=(), kwargs={}):
+    return kwargs.get('app_name') or (args and isinstance(args[0], basestring) \
+        and args[0]) or None
+
+def _get_retry_delay(retries=0):
+    # full jitter: anywhere between 0 and the exponential backoff
+    return random.uniform(0, min(settings.QUEUE_RETRY_MAX_DELAY, \
+        settings.QUEUE_RETRY_BACKOFF * 2 ** retries))
+
+def _retry_task(envelope={}, countdown=None):
+    eta = time.time() + countdown
+    s = encode_task(envelope['task'], envelope['id'], envelope['args'], \
+        envelope['kwargs'], envelope['lane'], envelope['date'], envelope['retries'] + 1, \
+        eta=eta, max_retries=envelope.get('max_retries'))
+    data = schema.task(envelope['id'], envelope['task'], \
+        _get_app_name(envelope['args'], envelope['kwargs']), envelope['lane'], eta=eta)
+    utils.add_pending_task(s, data, max_signals=MAX_SIGNALS)
+    return eta
+
+def _get_task_key(name=None, args=(), kwargs={}, app_name=None, coalesce=False, \
+    supersede=False):
+    # coalescing key: the application for superseding tasks, all the
+    # arguments otherwise
+    if supersede and app_name:
+        return '{0}:{1}'.format(name, app_name)
+    if coalesce:
+        return '{0}:{1}'.format(name, \
+            hashlib.sha1(json.dumps([args, kwargs], sort_keys=True)).hexdigest())
+    return None
+
+def encode_task(name=None, task_id=None, args=(), kwargs={}, lane=None, \
+    date=None, retries=0, key=None, redeliveries=0, eta=None, max_retries=None):
+    """
+    Returns the queued (JSON) envelope of a task call
+
+    :keyword max_retries: (optional) Overrides the ``max_retries`` of the task
+
+    """
+    data = {
+        'v': ENVELOPE_VERSION,
+        'task': name,
+        'id': task_id,
+        'args': list(args),
+        'kwargs': kwargs,
+        'lane': lane or settings.QUEUE_DEFAULT_LANE,
+        'date': date or time.time(),
+        'retries': retries,
+        'redeliveries': redeliveries,
+        'key': key,
+        'eta': eta,
+        'max_retries': max_retries,
+    }
+    return json.dumps(data, separators=(',', ':'))
+
+def decode_task(msg=None):
+    """
+    Returns the envelope of a queued task as a dict
+
+    """
+    if msg.startswith('{'):
+        return json.loads(msg)
+    # pickled (func, task_id, args, kwargs[, lane]) queued by older versions
+    data = pickle.loads(msg)
+    return {
+        'v': 0,
+        'task': data[0].__name__,
+        'id': data[1],
+        'args': list(data[2]),
+        'kwargs': data[3],
+        'lane': data[4] if len(data) > 4 else settings.QUEUE_DEFAULT_LANE,
+        'date': None,
+        'retries': 0,
+        'redeliveries': 0,
+        'key': None,
+        'eta': None,
+        'max_retries': None,
+    }
+
+def run_task(msg=None, rv_ttl=settings.TASK_QUEUE_KEY_TTL):
+    """
+    Runs a single queued task and stores its result
+
+    :keyword msg: Task payload as pushed by ``delay``
+    :keyword rv_ttl: Seconds to keep the result
+
+    """
+    envelope = decode_task(msg)
+    task_id = envelope['id']
+    print('Running task: {0} ({1})'.format(envelope['task'], task_id))
+    func = TASKS.get(envelope['task'])
+    data = {'date': time.time(), 'task_id': task_id, 'status': 'running', 'result': None}
+    if func is None:
+        data['status'] = 'error'
+        data['result'] = 'unknown task: {0}'.format(envelope['task'])
+        utils.set_task_result(task_id, data, rv_ttl)
+        return
+    utils.set_task_result(task_id, data)
+    started = data['date']
+    _context.task_id = task_id
+    emit_event('status', status='running')
+    args = envelope['args']
+    kwargs = envelope['kwargs']
+    try:
+        rv = func(*args, **kwargs)
+        data['status'] = 'complete'
+    except Exception, e:
+        import traceback
+        traceback.print_exc()
+        rv = e
+        data['status'] = 'error'
+        max_retries = envelope.get('max_retries')
+        if max_retries is None:
+            max_retries = func.max_retries
+        if envelope['retries'] < max_retries:
+            countdown = getattr(e, 'countdown', None)
+            if countdown is None:
+                countdown = _get_retry_delay(envelope['retries'])
+            data['status'] = 'retrying'
+            data['eta'] = _retry_task(envelope, countdown)
+            print('Task {0}: retrying in {1:.1f}s'.format(task_id, countdown))
+    if isinstance(rv, dict):
+        rv = json.dumps(rv)
+    else:
+        rv = str(rv)
+    data['result'] = rv
+    if rv is not None:
+        utils.set_task_result(task_id, data, rv_ttl)
+    try:
+        # time spent queued counts from when the task was due
+        queued = envelope.get('eta') or envelope['date']
+        metrics.record_task(envelope['task'], data['status'], \
+            queued and started - queued, time.time() - started)
+    except Exception:
+        # never let metrics break the task
+        pass
+    if data['status'] == 'retrying':
+        emit_event('status', status='retrying', eta=data['eta'])
+    else:
+        emit_event('done', status=data['status'])
+    _context.task_id = None
+
+# moves a task (ARGV[1]) from a processing list back to its lane as
+# ARGV[2] (only if it is still there, so concurrent reapers re-queue it
+# once) and wakes a worker
+REQUEUE_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+    redis.call('LPUSH', KEYS[3], 1)
+    return 1
+end
+return 0
+"""
+
+# takes the next task from the first non-empty lane (KEYS[1..n-1]) into the
+# processing list (KEYS[n])
+DEQUEUE_SCRIPT = """
+for i = 1, #KEYS - 1 do
+    local msg = redis.call('RPOPLPUSH', KEYS[i], KEYS[#KEYS])
+    if msg then
+        return msg
+    end
+end
+return false
+"""
+
+def _get_lanes(turn=0):
+    # strict priority, except every QUEUE_LANE_FAIRNESS-th turn which starts
+    # from the next lane down (rotating) so lower lanes are never starved
+    lanes = list(settings.QUEUE_LANES)
+    fairness = settings.QUEUE_LANE_FAIRNESS
+    if fairness and len(lanes) > 1 and turn % fairness == fairness - 1:
+        start = 1 + (turn // fairness) % (len(lanes) - 1)
+        lanes = lanes[start:] + lanes[:start]
+    return lanes
+
+def dequeue(db=None, processing_key=None, turn=0, timeout=None):
+    """
+    Moves the next task into ``processing_key`` and returns it (or None
+    after ``timeout`` seconds without tasks)
+
+    :keyword turn: Number of tasks taken so far (for lane fairness)
+
+    """
+    keys = [utils.get_queue_lane_key(x) for x in _get_lanes(turn)]
+    keys.append(processing_key)
+    msg = db.execute_command('EVAL', DEQUEUE_SCRIPT, len(keys), *keys)
+    if msg is None and db.brpop(schema.TASK_SIGNAL_KEY, timeout=timeout):
+        msg = db.execute_command('EVAL', DEQUEUE_SCRIPT, len(keys), *keys)
+    return msg
+
+def _get_max_rss():
+    # peak resident memory in MB (ru_maxrss is in KB on linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _heartbeat(worker_id=None, stop=None):
     db = application.get_db_connection()
-    while True:
-        msg = db.blpop(settings.TASK_QUEUE_NAME)
-        print('Running task: {0}'.format(msg))
-        func, task_id, args, kwargs = pickle.loads(msg[1])
-        qkey = settings.TASK_QUEUE_NAME
-        key = '{0}:{1}'.format(qkey, task_id)
-        data = {'date': time.time(), 'task_id': task_id, 'status': 'running', 'result': None}
-        db.set(key, json.dumps(data))
-        try:
-            rv = func(*args, **kwargs)
-            data['status'] = 'complete'
-        except Exception, e:
-            import traceback
-            traceback.print_exc()
-            rv = e
-            data['status'] = 'error'
-        if isinstance(rv, dict):
-            rv = json.dumps(rv)
-        else:
-            rv = str(rv)
-        data['result'] = rv
-        if rv is not None:
-            db.set(key, json.dumps(data))
-            db.expire(key, rv_ttl)
+    lease_key = schema.WORKER_LEASE_KEY.format(worker_id)
+    while not stop.is_set():
+        db.setex(lease_key, worker_id, settings.QUEUE_LEASE_TTL)
+        stop.wait(settings.QUEUE_LEASE_TTL / 3.0)
+
+def reap_workers():
+    """
+    Re-queues the in-flight tasks of workers whose lease expired
+
+    Tasks that were already re-queued ``QUEUE_MAX_REDELIVERIES`` times
+    (``redeliveries`` in the envelope) are marked as failed instead
+
+    """
+    db = application.get_db_connection()
+    reaped = 0
+    for worker_id in db.smembers(schema.WORKERS_KEY):
+        if db.exists(schema.WORKER_LEASE_KEY.format(worker_id)):
+            continue
+        processing_key = schema.WORKER_PROCESSING_KEY.format(worker_id)
+        for msg in db.lrange(processing_key, 0, -1):
+            envelope = decode_task(msg)
+            task_id = envelope['id']
+            redeliveries = envelope.get('redeliveries', 0) + 1
+            if redeliveries > settings.QUEUE_MAX_REDELIVERIES:
+                if db.lrem(processing_key, msg, 1):
+                    data = {'date': time.time(), 'task_id': task_id, 'status': 'error', \
+                        'result': 'worker lost {0} times'.format(redeliveries)}
+                    utils.set_task_result(task_id, data, settings.TASK_QUEUE_KEY_TTL)
+                    print('Task {0}: failed after {1} lost workers'.format(task_id, redeliveries))
+            elif db.execute_command('EVAL', REQUEUE_SCRIPT, 3, processing_key, \
+                utils.get_queue_lane_key(envelope['lane']), schema.TASK_SIGNAL_KEY, msg, \
+                encode_task(envelope['task'], task_id, envelope['args'], \
+                envelope['kwargs'], envelope['lane'], envelope['date'], envelope['retries'], \
+                envelope.get('key'), redeliveries, envelope.get('eta'), \
+                envelope.get('max_retries'))):
+                print('Task {0}: worker {1} lost, re-queued'.format(task_id, worker_id))
+            reaped += 1
+        if not db.llen(processing_key):
+            db.srem(schema.WORKERS_KEY, worker_id)
+    return reaped
+
+def queue_worker(rv_ttl=settings.TASK_QUEUE_KEY_TTL, max_tasks=None, max_memory=None, \
+    supervised=True):
+    """
+    Runs queued tasks until ``max_tasks`` have run or the process has used
+    more than ``max_memory`` MB (or the supervisor goes away)
+
+    Each task is moved to this worker's processing list while it runs and a
+    heartbeat keeps the worker lease alive so ``reap_workers`` can recover
+    tasks of workers that died.
+
+    """
+    db = application.get_db_connection()
+    worker_id = '{0}:{1}'.format(os.getpid(), uuid.uuid4().hex[:8])
+    processing_key = schema.WORKER_PROCESSING_KEY.format(worker_id)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(worker_id, stop))
+    heartbeat.daemon = True
+    db.setex(schema.WORKER_LEASE_KEY.format(worker_id), worker_id, settings.QUEUE_LEASE_TTL)
+    db.sadd(schema.WORKERS_KEY, worker_id)
+    heartbeat.start()
+    parent_pid = os.getppid()
+    tasks_run = 0
+    last_reap = time.time()
+    try:
+        while True:
+            timeout = settings.QUEUE_POLL_TIMEOUT
+            if not supervised:
+                # no supervisor -- recover tasks of lost workers (also while
+                # busy), run the scheduler here and wake up for the next
+                # delayed task
+                if time.time() - last_reap >= settings.QUEUE_LEASE_TTL:
+                    reap_workers()
+                    last_reap = time.time()
+                utils.promote_scheduled_tasks()
+                eta = utils.get_next_scheduled_task_eta()
+                if eta is not None:
+                    timeout = max(1, min(timeout, int(math.ceil(eta - time.time()))))
+            msg = dequeue(db, processing_key, tasks_run, timeout)
+            if msg is None:
+                if supervised and os.getppid() != parent_pid:
+                    break
+                if not supervised:
+                    reap_workers()
+                    last_reap = time.time()
+                continue
+            envelope = decode_task(msg)
+            task_id = envelope['id']
+            if utils.claim_task(task_id, envelope.get('key')):
+                run_task(msg, rv_ttl)
+            else:
+                print('Task {0}: cancelled'.format(task_id))
+            # ack
+            db.lrem(processing_key, msg, 1)
+            tasks_run += 1
+            if max_tasks and tasks_run >= max_tasks:
+                print('Worker {0}: ran {1} tasks, recycling'.format(os.getpid(), tasks_run))
+                break
+            if max_memory and _get_max_rss() > max_memory:
+                print('Worker {0}: using {1}MB, recycling'.format(os.getpid(), _get_max_rss()))
+                break
+    finally:
+        stop.set()
+        # leave the registry only with nothing in flight
+        if not db.llen(processing_key):
+            pipe = db.pipeline()
+            pipe.delete(schema.WORKER_LEASE_KEY.format(worker_id))
+            pipe.srem(schema.WORKERS_KEY, worker_id)
+            pipe.execute()
+
+def queue_daemon(app, rv_ttl=settings.TASK_QUEUE_KEY_TTL, concurrency=None):
+    """
+    Runs the task queue
+
+    With a concurrency of 1 tasks run in this process one at a time.
+    Otherwise a pool of ``concurrency`` worker processes drains the queue
+    and workers that exit (crash, task or memory limit) are replaced.
+    Delayed tasks are moved onto the lanes as they become due.
+
+    :keyword concurrency: Number of workers (default ``QUEUE_CONCURRENCY``,
+        0 uses the number of cpus)
+
+    """
+    if concurrency is None:
+        concurrency = settings.QUEUE_CONCURRENCY
+    if concurrency == 0:
+        concurrency = multiprocessing.cpu_count()
+    # recover tasks left behind by a previous run
+    reap_workers()
+    if concurrency <= 1:
+        while True:
+            queue_worker(rv_ttl, supervised=False)
+    # make sure the workers are stopped with the supervisor
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = {}
+    try:
+        while True:
+            for i in range(concurrency):
+                worker = workers.get(i)
+                if worker is not None and worker.is_alive():
+                    continue
+                if worker is not None:
+                    worker.join()
+                    print('Worker {0} exited ({1}), restarting'.format(worker.pid, worker.exitcode))
+                worker = multiprocessing.Process(target=queue_worker, args=(rv_ttl,), \
+                    kwargs={'max_tasks': settings.QUEUE_WORKER_MAX_TASKS, \
+                    'max_memory': settings.QUEUE_WORKER_MAX_MEMORY})
+                worker.daemon = True
+                worker.start()
+                workers[i] = worker
+            reap_workers()
+            utils.promote_scheduled_tasks()
+            time.sleep(settings.QUEUE_SUPERVISOR_INTERVAL)
+    finally:
+        for worker in workers.values():
+            if worker.is_alive():
+                worker.terminate()
 
 if __name__=='__main__':
+    from optparse import OptionParser
+    op = OptionParser()
+    op.add_option('--concurrency', dest='concurrency', type=int, default=None, \
+        help='Number of worker processes (0 = number of cpus)')
+    opts, args = op.parse_args()
     from application import app
+    # tasks register with the imported module (not __main__)
+    import queue
     print('Starting queue...')
     try:
-        queue_daemon(app)
+        queue.queue_daemon(app, concurrency=opts.concurrency)
     except KeyboardInterrupt:
         print('Exiting...')
-
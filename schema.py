@@ -1,15 +1,52 @@
 #!/usr/bin/env python
 import time
+import uuid
 import settings
 
-APP_KEY = 'applications:{0}:{1}'
-LOG_KEY = 'logs:{0}:'.format(settings.NODE_NAME) + '{0}'
+APP_KEY = 'applications:{0}'
+APP_INSTANCES_FIELD = 'instances:{0}'
+LEGACY_APP_KEY = 'applications:{0}:'
+APP_VERSIONS_KEY = 'versions:applications'
+LEGACY_LOG_KEY = 'logs:{0}:'.format(settings.NODE_NAME) + '{0}'
+LOGS_KEY = 'logs:{0}'.format(settings.NODE_NAME)
 NODE_KEY = 'nodes:{0}'
 NODE_APPS_KEY = '{0}:applications'.format(NODE_KEY)
-PORTS_KEY = '{0}:ports'.format(NODE_KEY.format(settings.NODE_NAME))
+PORTS_KEY = '{0}:portmap'.format(NODE_KEY.format(settings.NODE_NAME))
+LEGACY_PORTS_KEY = '{0}:ports'.format(NODE_KEY.format(settings.NODE_NAME))
 ROLE_KEY = 'roles:{0}'
 USER_KEY = 'users:{0}'
 HEARTBEAT_KEY = 'heartbeat:{0}'.format(settings.NODE_NAME)
+TASK_KEY = '{0}:'.format(settings.TASK_QUEUE_NAME) + '{0}'
+# compressed full output of large task results (list of chunks)
+TASK_OUTPUT_KEY = 'output:{0}:'.format(settings.NODE_NAME) + '{0}'
+# task counters and latency histograms (hash, see utils.metrics)
+TASK_METRICS_KEY = 'metrics:tasks:{0}'.format(settings.NODE_NAME)
+# progress events of a task (stream)
+TASK_EVENTS_KEY = 'events:{0}:'.format(settings.NODE_NAME) + '{0}'
+# completion notification waiters block on (see utils.wait_for_task)
+TASK_DONE_KEY = 'done:{0}:'.format(settings.NODE_NAME) + '{0}'
+# priority lanes (the default lane is TASK_QUEUE_NAME) and the list idle
+# workers block on to be woken up for new tasks
+TASK_LANE_KEY = 'lanes:{0}:'.format(settings.NODE_NAME) + '{0}'
+TASK_SIGNAL_KEY = 'signal:{0}'.format(settings.NODE_NAME)
+# pending tasks by task id (hash) and the ids of cancelled tasks still queued
+PENDING_TASKS_KEY = 'pending:{0}'.format(settings.NODE_NAME)
+# coalescing key -> pending task id
+PENDING_TASK_KEYS_KEY = 'pending:{0}:keys'.format(settings.NODE_NAME)
+TASK_CANCELLED_KEY = 'cancelled:{0}'.format(settings.NODE_NAME)
+# delayed tasks (zset of queued messages by eta)
+TASK_SCHEDULE_KEY = 'schedule:{0}'.format(settings.NODE_NAME)
+# reliable delivery: per worker in-flight list, lease and the worker registry
+WORKER_LEASE_KEY = 'lease:{0}:'.format(settings.NODE_NAME) + '{0}'
+WORKER_PROCESSING_KEY = 'processing:{0}:'.format(settings.NODE_NAME) + '{0}'
+WORKERS_KEY = 'workers:{0}'.format(settings.NODE_NAME)
+# secondary indexes (maintained alongside the records)
+APPS_INDEX_KEY = 'index:applications'
+LEGACY_LOGS_INDEX_KEY = 'index:logs:{0}'.format(settings.NODE_NAME)
+PENDING_TASKS_INDEX_KEY = 'index:pending:{0}'.format(settings.NODE_NAME)
+ROLES_INDEX_KEY = 'index:roles'
+TASKS_INDEX_KEY = 'index:tasks:{0}'.format(settings.NODE_NAME)
+USERS_INDEX_KEY = 'index:users'
 
 def user(username=None, first_name=None, last_name=None, email=None, \
     password=None, role=None, enabled=True):
@@ -29,9 +66,23 @@ def role(rolename=None):
 
 def log(level=None, category='root', message=None):
     data = {
+        'id': uuid.uuid4().hex,
         'date': time.time(),
         'level': level,
         'category': category,
         'message': message,
     }
     return data
+
+def task(task_id=None, name=None, application=None, lane=None, key=None, eta=None):
+    data = {
+        'task_id': task_id,
+        'date': time.time(),
+        'task': name,
+        'application': application,
+        'lane': lane,
+        'key': key,
+        'eta': eta,
+        'status': 'new',
+    }
+    return data
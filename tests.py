@@ -3,15 +3,21 @@ import logging
 import tempfile
 import os
 import shutil
+import time
 from random import Random
 import string
 from subprocess import call, Popen, PIPE
 import tarfile
+import glob
+import multiprocessing
+import threading
+import pickle
 import application
+import queue
 import settings
 import utils
 import schema
-from utils import deploy
+from utils import deploy, pool, metrics, packages, releases, virtualenvs
 try:
     import simplejson as json
 except ImportError:
@@ -34,6 +40,7 @@ class CoreTestCase(unittest.TestCase):
         # create
         assert utils.create_user(username=test_user, password='na', role=test_role)
         assert utils.get_user(test_user) != None
+        assert test_user in [json.loads(x)['username'] for x in utils.get_users()]
         # toggle
         assert utils.toggle_user(test_user, False)
         user_data = json.loads(utils.get_user(test_user))
@@ -47,8 +54,23 @@ class CoreTestCase(unittest.TestCase):
         # delete
         assert utils.delete_user(test_user)
         assert utils.get_user(test_user) == None
+        assert test_user not in [json.loads(x)['username'] for x in utils.get_users()]
         assert utils.delete_role(test_role)
     
+    def test_user_context(self):
+        test_user = get_random_string()
+        assert utils.create_user(username=test_user, password='na', role='admin')
+        self.client.post('/login/', data={'username': test_user, 'password': 'na'})
+        resp = self.client.get('/accounts/')
+        assert resp.status_code == 200
+        assert test_user in resp.data
+        assert test_user in [x['user']['username'] for x in utils.user_cache._entries.values()]
+        # toggling the user drops the cached record
+        assert utils.toggle_user(test_user, False)
+        assert test_user not in [x['user']['username'] for x in utils.user_cache._entries.values()]
+        self.client.get('/logout/')
+        assert utils.delete_user(test_user)
+
     def test_role_ops(self):
         test_role = get_random_string()
         assert utils.create_role(test_role)
@@ -59,6 +81,16 @@ class CoreTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
+def cleanup_virtualenv(fingerprint=None):
+    path = virtualenvs.get_virtualenv_path(fingerprint)
+    if os.path.islink(path):
+        os.remove(path)
+    for build_dir in glob.glob(path + '*'):
+        if os.path.isdir(build_dir):
+            shutil.rmtree(build_dir)
+        else:
+            os.remove(build_dir)
+
 class DeployTestCase(unittest.TestCase):
     def setUp(self):
         pass
@@ -82,9 +114,18 @@ class DeployTestCase(unittest.TestCase):
         # deploy
         deploy.deploy_app(package=tmp_pkg, build_ve=False)
         tmp_app_dir = os.path.join(settings.APPLICATION_BASE_DIR, tmp_app_name)
+        tmp_current_dir = os.path.join(tmp_app_dir, 'current')
         assert os.path.exists(os.path.join(settings.APPLICATION_BASE_DIR, tmp_app_name))
-        assert os.listdir(os.path.join(tmp_app_dir, tmp_app_name)) > 0
-        assert os.path.exists(os.path.join(os.path.join(tmp_app_dir, tmp_app_name), 'testfile'))
+        assert os.listdir(os.path.join(tmp_current_dir, tmp_app_name)) > 0
+        assert os.path.exists(os.path.join(os.path.join(tmp_current_dir, tmp_app_name), 'testfile'))
+        # linked from the package cache
+        assert os.path.islink(os.path.join(tmp_current_dir, tmp_app_name))
+        # a redeploy adds a release and switches to it
+        release = releases.get_current_release(tmp_app_name)
+        deploy.deploy_app(package=tmp_pkg, build_ve=False)
+        assert releases.get_current_release(tmp_app_name) != release
+        assert releases.get_previous_release(tmp_app_name) == release
+        assert os.path.exists(os.path.join(tmp_current_dir, tmp_app_name, 'testfile'))
         # cleanup
         if os.path.exists(tmp_app_file):
             os.remove(tmp_app_file)
@@ -95,6 +136,249 @@ class DeployTestCase(unittest.TestCase):
         if os.path.exists(tmp_app_dir):
             shutil.rmtree(tmp_app_dir)
 
+    def test_deploy_retry(self):
+        tmp_app_name = get_random_string()
+        tmp_manifest = tempfile.mktemp()
+        with open(tmp_manifest, 'w') as f:
+            data = {"application": tmp_app_name, "repo_type": "git", \
+                "repo_url": tempfile.mktemp()}
+            f.write(json.dumps(data))
+        tmp_pkg = tempfile.mktemp()
+        tf = tarfile.open(tmp_pkg, 'w:gz')
+        tf.add(tmp_manifest, arcname='manifest.json')
+        tf.close()
+        tmp_app_dir = os.path.join(settings.APPLICATION_BASE_DIR, tmp_app_name)
+        try:
+            # a failed clone is retried and leaves no release behind
+            self.assertRaises(queue.Retry, deploy.deploy_app, package=tmp_pkg, \
+                build_ve=False)
+            assert releases.get_releases(tmp_app_name) == []
+        finally:
+            os.remove(tmp_manifest)
+            os.remove(tmp_pkg)
+            if os.path.exists(tmp_app_dir):
+                shutil.rmtree(tmp_app_dir)
+
+    def test_releases(self):
+        tmp_app_name = get_random_string()
+        tmp_app_dir = os.path.join(settings.APPLICATION_BASE_DIR, tmp_app_name)
+        # installed before releases
+        os.makedirs(os.path.join(tmp_app_dir, tmp_app_name))
+        try:
+            names = []
+            for x in range(3):
+                release = releases.create_release(tmp_app_name, version=str(x))
+                os.makedirs(os.path.join(releases.get_release_dir(tmp_app_name, release), \
+                    tmp_app_name))
+                names.append(release)
+            assert [x['release'] for x in releases.get_releases(tmp_app_name)] == \
+                sorted(names, reverse=True)
+            assert releases.get_current_release(tmp_app_name) is None
+            assert releases.activate_release(tmp_app_name, names[-1])
+            assert releases.get_current_release(tmp_app_name) == names[-1]
+            assert releases.get_release_info(tmp_app_name, names[-1])['version'] == '2'
+            assert releases.get_release_code_dir(tmp_app_name, names[-1]) == tmp_app_name
+            # the old layout is cleaned up after the switch
+            assert sorted(os.listdir(tmp_app_dir)) == ['current', 'releases']
+            assert releases.get_previous_release(tmp_app_name) == names[1]
+            releases.activate_release(tmp_app_name, names[0])
+            assert releases.get_previous_release(tmp_app_name) is None
+            # the current release is always kept
+            assert releases.prune_releases(tmp_app_name, keep=1) == [names[1]]
+            assert [x['release'] for x in releases.get_releases(tmp_app_name)] == \
+                [names[2], names[0]]
+            self.assertRaises(RuntimeError, releases.remove_release, tmp_app_name, names[0])
+        finally:
+            shutil.rmtree(tmp_app_dir)
+
+    def test_rollback_missing_virtualenv(self):
+        tmp_app_name = get_random_string()
+        tmp_bin = tempfile.mkdtemp()
+        # stand-in virtualenv that fails
+        with open(os.path.join(tmp_bin, 'virtualenv'), 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        os.chmod(os.path.join(tmp_bin, 'virtualenv'), 0755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = '{0}:{1}'.format(tmp_bin, path)
+        fingerprint = get_random_string()
+        try:
+            old = releases.create_release(tmp_app_name, fingerprint=fingerprint)
+            new = releases.create_release(tmp_app_name)
+            releases.activate_release(tmp_app_name, new)
+            # neither cached nor rebuildable -- nothing is switched
+            self.assertRaises(RuntimeError, deploy.rollback_application, tmp_app_name)
+            assert releases.get_current_release(tmp_app_name) == new
+            # rebuilt from the dependencies of the release (and the build fails)
+            info = releases.get_release_info(tmp_app_name, old)
+            info.update({'packages': ['redis'], 'requirements': 'flask\n'})
+            releases.set_release_info(tmp_app_name, old, info)
+            self.assertRaises(RuntimeError, deploy.rollback_application, tmp_app_name)
+            assert releases.get_current_release(tmp_app_name) == new
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(tmp_bin)
+            shutil.rmtree(os.path.join(settings.APPLICATION_BASE_DIR, tmp_app_name))
+
+    def test_package_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        tmp_pkg = os.path.join(tmp_dir, 'package.tar.gz')
+        with open(os.path.join(tmp_dir, 'testfile'), 'w') as f:
+            f.write(get_random_string())
+        tf = tarfile.open(tmp_pkg, 'w:gz')
+        tf.add(os.path.join(tmp_dir, 'testfile'), arcname='testfile')
+        tf.close()
+        try:
+            digest, path = packages.extract_package(tmp_pkg)
+            assert digest == packages.get_package_digest(tmp_pkg)
+            assert os.path.exists(os.path.join(path, 'testfile'))
+            # extracted once
+            os.remove(os.path.join(path, 'testfile'))
+            assert packages.extract_package(tmp_pkg) == (digest, path)
+            assert not os.path.exists(os.path.join(path, 'testfile'))
+            assert digest in [x['digest'] for x in packages.get_cached_packages()]
+            assert digest not in packages.prune_package_cache(max_entries=0, keep=[digest])
+            assert digest in packages.prune_package_cache(max_entries=0)
+            assert not os.path.exists(path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_virtualenv_cache(self):
+        tmp_reqs = tempfile.mktemp()
+        with open(tmp_reqs, 'w') as f:
+            f.write('# deps\nrequests\n\nflask\n')
+        fingerprint = virtualenvs.get_virtualenv_fingerprint(['redis'], tmp_reqs)
+        with open(tmp_reqs, 'w') as f:
+            f.write('flask\nrequests # http\n')
+        assert virtualenvs.get_virtualenv_fingerprint(['redis'], tmp_reqs) == fingerprint
+        assert virtualenvs.get_virtualenv_fingerprint(['redis'], tmp_reqs, 'python2.6') != \
+            fingerprint
+        apps = [get_random_string() for x in range(2)]
+        def build():
+            build_dir = virtualenvs.get_virtualenv_build_dir(fingerprint)
+            os.makedirs(build_dir)
+            virtualenvs.activate_virtualenv_build(fingerprint, build_dir)
+            return build_dir
+        # a built environment
+        try:
+            first_build = build()
+            assert virtualenvs.is_virtualenv_complete(fingerprint)
+            for app in apps:
+                virtualenvs.link_virtualenv(app, fingerprint)
+            assert os.path.exists(os.path.join(settings.VIRTUALENV_BASE_DIR, apps[0], \
+                virtualenvs.COMPLETE_MARKER))
+            assert sorted(virtualenvs.get_virtualenv_refs()[fingerprint]) == sorted(apps)
+            # a rebuild is swapped in -- linked applications never lose it
+            second_build = build()
+            assert os.path.realpath(os.path.join(settings.VIRTUALENV_BASE_DIR, apps[0])) == \
+                second_build
+            assert os.path.exists(first_build)
+            assert sorted(virtualenvs.get_virtualenv_refs()[fingerprint]) == sorted(apps)
+            virtualenvs.unlink_virtualenv(apps[0])
+            assert fingerprint not in virtualenvs.prune_virtualenvs(ttl=0)
+            # the replaced build goes once unused
+            assert not os.path.exists(first_build)
+            assert os.path.exists(second_build)
+            virtualenvs.unlink_virtualenv(apps[1])
+            assert fingerprint not in virtualenvs.prune_virtualenvs()
+            assert fingerprint in virtualenvs.prune_virtualenvs(ttl=0)
+            assert not os.path.lexists(virtualenvs.get_virtualenv_path(fingerprint))
+            assert not os.path.exists(second_build)
+        finally:
+            for app in apps:
+                virtualenvs.unlink_virtualenv(app)
+            cleanup_virtualenv(fingerprint)
+            os.remove(tmp_reqs)
+
+    def test_virtualenv_rollback_retention(self):
+        tmp_app = get_random_string()
+        old, new = [virtualenvs.get_virtualenv_fingerprint([x]) for x in ('redis', 'flask')]
+        try:
+            for fingerprint in (old, new):
+                build_dir = virtualenvs.get_virtualenv_build_dir(fingerprint)
+                os.makedirs(build_dir)
+                virtualenvs.activate_virtualenv_build(fingerprint, build_dir)
+            # linked long ago
+            virtualenvs.link_virtualenv(tmp_app, old)
+            then = time.time() - settings.VIRTUALENV_CACHE_TTL - 60
+            os.utime(virtualenvs.get_virtualenv_path(old), (then, then))
+            # the virtualenv being left is kept for a rollback
+            virtualenvs.link_virtualenv(tmp_app, new)
+            assert old not in virtualenvs.prune_virtualenvs()
+            assert virtualenvs.is_virtualenv_complete(old)
+            # and for as long as a kept release was deployed with it
+            release = releases.create_release(tmp_app, fingerprint=old)
+            assert old not in virtualenvs.prune_virtualenvs(ttl=0)
+            releases.remove_release(tmp_app, release)
+            assert old in virtualenvs.prune_virtualenvs(ttl=0)
+        finally:
+            virtualenvs.unlink_virtualenv(tmp_app)
+            shutil.rmtree(os.path.join(settings.APPLICATION_BASE_DIR, tmp_app), ignore_errors=True)
+            for fingerprint in (old, new):
+                cleanup_virtualenv(fingerprint)
+
+    def test_install_virtualenv_failure(self):
+        tmp_app = get_random_string()
+        tmp_bin = tempfile.mkdtemp()
+        # stand-in virtualenv that fails
+        with open(os.path.join(tmp_bin, 'virtualenv'), 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        os.chmod(os.path.join(tmp_bin, 'virtualenv'), 0755)
+        fingerprint = virtualenvs.get_virtualenv_fingerprint(['redis'])
+        path = os.environ['PATH']
+        os.environ['PATH'] = '{0}:{1}'.format(tmp_bin, path)
+        try:
+            rv = deploy.install_virtualenv(application=tmp_app, packages=['redis'])
+            assert 'virtualenv' in rv['errors']
+            assert not virtualenvs.is_virtualenv_complete(fingerprint)
+            assert not os.path.lexists(os.path.join(settings.VIRTUALENV_BASE_DIR, tmp_app))
+            # a failed forced rebuild keeps the existing build
+            build_dir = virtualenvs.get_virtualenv_build_dir(fingerprint)
+            os.makedirs(build_dir)
+            virtualenvs.activate_virtualenv_build(fingerprint, build_dir)
+            virtualenvs.link_virtualenv(tmp_app, fingerprint)
+            rv = deploy.install_virtualenv(application=tmp_app, packages=['redis'], force=True)
+            assert 'virtualenv' in rv['errors']
+            assert virtualenvs.is_virtualenv_complete(fingerprint)
+            assert os.path.realpath(os.path.join(settings.VIRTUALENV_BASE_DIR, tmp_app)) == \
+                build_dir
+        finally:
+            os.environ['PATH'] = path
+            virtualenvs.unlink_virtualenv(tmp_app)
+            cleanup_virtualenv(fingerprint)
+            shutil.rmtree(tmp_bin)
+
+    def test_install_requirements(self):
+        tmp_ve = tempfile.mkdtemp()
+        tmp_log = os.path.join(tmp_ve, 'pip.log')
+        tmp_reqs = os.path.join(tmp_ve, 'requirements.txt')
+        with open(tmp_reqs, 'w') as f:
+            f.write('flask')
+        # stand-in pip that records its arguments
+        os.makedirs(os.path.join(tmp_ve, 'bin'))
+        with open(os.path.join(tmp_ve, 'bin', 'pip'), 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> {0}\n'.format(tmp_log))
+        os.chmod(os.path.join(tmp_ve, 'bin', 'pip'), 0755)
+        offline = settings.PIP_OFFLINE
+        try:
+            deps = deploy._get_pip_requirements(['requests', 'redis'], tmp_reqs)
+            assert deploy._install_requirements(tmp_ve, deps) == 0
+            with open(tmp_log, 'r') as f:
+                calls = f.read().splitlines()
+            # wheels built once, then a single install from the wheelhouse
+            assert len(calls) == 2
+            assert calls[0].startswith('wheel --wheel-dir {0}'.format(settings.WHEELHOUSE_DIR))
+            assert calls[1] == 'install --no-index --find-links {0} requests redis -r {1}'.format( \
+                settings.WHEELHOUSE_DIR, tmp_reqs)
+            os.remove(tmp_log)
+            settings.PIP_OFFLINE = True
+            assert deploy._install_requirements(tmp_ve, deps) == 0
+            with open(tmp_log, 'r') as f:
+                calls = f.read().splitlines()
+            assert len(calls) == 1 and calls[0].startswith('install --no-index')
+        finally:
+            settings.PIP_OFFLINE = offline
+            shutil.rmtree(tmp_ve)
+
     def test_install_virtualenv(self):
         tmp_ve = get_random_string()
         tmp_ve_path = os.path.join(settings.VIRTUALENV_BASE_DIR, tmp_ve)
@@ -113,7 +397,7 @@ class DeployTestCase(unittest.TestCase):
         assert pip_freeze.find('requests') > -1
         assert pip_freeze.find('flask') > -1
         # cleanup
-        shutil.rmtree(tmp_ve_path)
+        virtualenvs.unlink_virtualenv(tmp_ve)
         os.remove(tmp_reqs)
 
     def test_install_virtualenv_custom_runtime(self):
@@ -134,7 +418,7 @@ class DeployTestCase(unittest.TestCase):
         assert pip_freeze.find('requests') > -1
         assert pip_freeze.find('flask') > -1
         # cleanup
-        shutil.rmtree(tmp_ve_path)
+        virtualenvs.unlink_virtualenv(tmp_ve)
         os.remove(tmp_reqs)
 
     def test_configure_supervisor(self):
@@ -159,6 +443,308 @@ class DeployTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
+@queue.task
+def sleep_task(seconds=0):
+    time.sleep(seconds)
+    return {'slept': seconds}
+
+@queue.task(coalesce=True)
+def coalesce_task(app_name=None):
+    return app_name
+
+@queue.task(supersede=True)
+def supersede_task(app_name=None, package=None):
+    return package
+
+@queue.task(max_retries=2)
+def flaky_task(key=None):
+    # fails on the first run
+    if application.get_db_connection().incr(key) < 2:
+        raise queue.Retry('try again', countdown=0.1)
+    return 'ok'
+
+@queue.task
+def progress_task(steps=0):
+    for x in range(steps):
+        with queue.step('step{0}'.format(x)) as s:
+            s.output('output of step {0}'.format(x))
+    return {'steps': steps}
+
+def wait_for_tasks(task_ids=[], timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        results = [utils.get_task(x) for x in task_ids]
+        if all(x and json.loads(x)['status'] not in ('new', 'running', 'retrying') \
+            for x in results):
+            return [json.loads(x) for x in results]
+        time.sleep(0.1)
+    return None
+
+class QueueTestCase(unittest.TestCase):
+    def test_queue_daemon_concurrency(self):
+        daemon = multiprocessing.Process(target=queue.queue_daemon, args=(None,), \
+            kwargs={'concurrency': 4})
+        daemon.start()
+        try:
+            start = time.time()
+            task_ids = [sleep_task.delay(1).key for x in range(4)]
+            results = wait_for_tasks(task_ids)
+            assert results != None
+            assert all(x['status'] == 'complete' for x in results)
+            # ran in parallel
+            assert time.time() - start < 4
+        finally:
+            daemon.terminate()
+            daemon.join()
+
+    def test_task_retry(self):
+        db = application.get_db_connection()
+        key = get_random_string()
+        daemon = multiprocessing.Process(target=queue.queue_daemon, args=(None,), \
+            kwargs={'concurrency': 1})
+        daemon.start()
+        try:
+            task_id = flaky_task.delay(key).key
+            results = wait_for_tasks([task_id])
+            assert results != None
+            assert results[0]['status'] == 'complete'
+            assert db.get(key) == '2'
+            # retries can be turned off per call
+            db.delete(key)
+            task_id = flaky_task.delay(key, max_retries=0).key
+            results = wait_for_tasks([task_id])
+            assert results != None
+            assert results[0]['status'] == 'error'
+            assert db.get(key) == '1'
+        finally:
+            daemon.terminate()
+            daemon.join()
+            db.delete(key)
+            utils.delete_task_result(task_id)
+
+    def test_scheduled_tasks(self):
+        db = application.get_db_connection()
+        task_id = sleep_task.delay(0, countdown=1).key
+        try:
+            assert json.loads(utils.get_task(task_id))['eta'] > time.time()
+            assert utils.get_next_scheduled_task_eta() > time.time()
+            assert utils.promote_scheduled_tasks() == 0
+            time.sleep(1.1)
+            assert utils.promote_scheduled_tasks() == 1
+            assert task_id in [queue.decode_task(x)['id'] for x in \
+                db.lrange(settings.TASK_QUEUE_NAME, 0, -1)]
+            assert queue._get_retry_delay(10) <= settings.QUEUE_RETRY_MAX_DELAY
+        finally:
+            utils.cancel_task(task_id)
+            for msg in db.lrange(settings.TASK_QUEUE_NAME, 0, -1):
+                if queue.decode_task(msg)['id'] == task_id:
+                    db.lrem(settings.TASK_QUEUE_NAME, msg)
+            utils.claim_task(task_id)
+
+    def test_task_progress(self):
+        daemon = multiprocessing.Process(target=queue.queue_daemon, args=(None,), \
+            kwargs={'concurrency': 1})
+        daemon.start()
+        try:
+            task_id = progress_task.delay(2).key
+            assert wait_for_tasks([task_id]) != None
+            events = [x[1] for x in utils.get_task_events(task_id)]
+            assert [x['type'] for x in events] == ['status', 'step', 'output', 'step', \
+                'step', 'output', 'step', 'done']
+            assert events[3]['status'] == 'finished'
+            assert events[3]['duration'] >= 0
+            assert events[-1]['status'] == 'complete'
+            # stream from an event id on
+            last_id = utils.get_task_events(task_id)[-2][0]
+            assert [x[1]['type'] for x in utils.get_task_events(task_id, last_id, 1)] == ['done']
+            c = application.app.test_client()
+            rv = c.get('/api/task/{0}/stream'.format(task_id), \
+                headers={'X-Apikey': settings.API_KEYS[0]})
+            assert rv.data.count('event: step') == 4
+            assert rv.data.count('event: done') == 1
+            assert '"status": "complete"' in rv.data.split('event: done')[1]
+        finally:
+            daemon.terminate()
+            daemon.join()
+            utils.delete_task_result(task_id)
+
+    def test_task_metrics(self):
+        db = application.get_db_connection()
+        name = get_random_string()
+        task_id = get_random_string()
+        def get_finished():
+            return int(db.hget(schema.TASK_METRICS_KEY, 'finished:sleep_task:complete') or 0)
+        finished = get_finished()
+        try:
+            metrics.record_task(name, 'complete', 0.2, 3)
+            metrics.record_task(name, 'error', 0.05, 4000)
+            rv = metrics.get_metrics()
+            assert 'terminus_tasks_finished_total{{status="error",task="{0}"}} 1'.format(name) in rv
+            assert 'terminus_task_wait_seconds_bucket{{le="0.1",task="{0}"}} 1'.format(name) in rv
+            assert 'terminus_task_wait_seconds_bucket{{le="0.5",task="{0}"}} 2'.format(name) in rv
+            assert 'terminus_task_duration_seconds_bucket{{le="+Inf",task="{0}"}} 2'.format(name) in rv
+            assert 'terminus_task_duration_seconds_sum{{task="{0}"}} 4003.0'.format(name) in rv
+            assert 'terminus_task_duration_seconds_count{{task="{0}"}} 2'.format(name) in rv
+            assert 'terminus_queue_depth{lane="default"}' in rv
+            # run_task records every run
+            queue.run_task(queue.encode_task('sleep_task', task_id, (0,)))
+            assert get_finished() == finished + 1
+            c = application.app.test_client()
+            rv = c.get('/api/metrics', headers={'X-Apikey': settings.API_KEYS[0]})
+            assert 'terminus_tasks_finished_total{status="complete",task="sleep_task"}' in rv.data
+        finally:
+            db.hdel(schema.TASK_METRICS_KEY, *[x for x in db.hkeys(schema.TASK_METRICS_KEY) \
+                if name in x])
+            utils.delete_task_result(task_id)
+
+    def test_reap_workers(self):
+        db = application.get_db_connection()
+        worker_id = get_random_string()
+        task_id = get_random_string()
+        processing_key = schema.WORKER_PROCESSING_KEY.format(worker_id)
+        def get_queued():
+            return [x for x in db.lrange(settings.TASK_QUEUE_NAME, 0, -1) \
+                if queue.decode_task(x)['id'] == task_id]
+        # a worker that died with a task in flight (no lease)
+        db.lpush(processing_key, queue.encode_task('sleep_task', task_id, (0,)))
+        db.sadd(schema.WORKERS_KEY, worker_id)
+        try:
+            assert queue.reap_workers() > 0
+            msg = get_queued()[0]
+            assert queue.decode_task(msg)['redeliveries'] == 1
+            assert worker_id not in db.smembers(schema.WORKERS_KEY)
+            # gives up after too many lost workers
+            for i in range(settings.QUEUE_MAX_REDELIVERIES):
+                msg = get_queued()[0]
+                db.lrem(settings.TASK_QUEUE_NAME, msg, 1)
+                db.lpush(processing_key, msg)
+                db.sadd(schema.WORKERS_KEY, worker_id)
+                queue.reap_workers()
+            assert get_queued() == []
+            assert json.loads(utils.get_task(task_id))['status'] == 'error'
+        finally:
+            for msg in get_queued():
+                db.lrem(settings.TASK_QUEUE_NAME, msg)
+            db.delete(processing_key)
+            db.srem(schema.WORKERS_KEY, worker_id)
+            utils.delete_task_result(task_id)
+
+    def test_task_wait(self):
+        task_id = get_random_string()
+        rv = queue.DelayedResult(task_id)
+        assert rv.wait(1) == None
+        data = {'task_id': task_id, 'status': 'complete', 'result': json.dumps({'a': 1})}
+        timer = threading.Timer(0.2, utils.set_task_result, (task_id, data))
+        timer.start()
+        try:
+            start = time.time()
+            assert rv.wait(5) == {'a': 1}
+            assert time.time() - start < 2
+            assert queue.DelayedResult(task_id).return_value == {'a': 1}
+            # later waiters return right away
+            assert json.loads(utils.wait_for_task(task_id, 5))['status'] == 'complete'
+        finally:
+            timer.join()
+            utils.delete_task_result(task_id)
+
+    def test_task_wait_capacity(self):
+        task_id = get_random_string()
+        blocking_pool = pool.get_blocking_connection_pool()
+        # a blocking pool with its only connection waiting
+        pool._blocking_pool = pool._create_pool(1)
+        conn = pool._blocking_pool.get_connection('BRPOPLPUSH')
+        try:
+            self.assertRaises(pool.PoolExhaustedError, utils.wait_for_task, task_id, 1)
+            c = application.app.test_client()
+            rv = c.get('/api/task/{0}?wait=1'.format(task_id), \
+                headers={'X-Apikey': settings.API_KEYS[0]})
+            assert rv.status_code == 503
+            rv = c.get('/api/task/{0}/stream'.format(task_id), \
+                headers={'X-Apikey': settings.API_KEYS[0]})
+            assert rv.status_code == 503
+            # other commands are unaffected
+            assert application.get_db_connection().ping()
+            pool._blocking_pool.release(conn)
+            assert utils.wait_for_task(task_id, 1) is None
+        finally:
+            pool._blocking_pool = blocking_pool
+
+    def test_task_coalescing(self):
+        db = application.get_db_connection()
+        app_name = get_random_string()
+        task_ids = []
+        try:
+            a = coalesce_task.delay(app_name).key
+            task_ids.append(a)
+            assert coalesce_task.delay(app_name).key == a
+            task_ids.append(coalesce_task.delay(get_random_string()).key)
+            assert task_ids[-1] != a
+            # once running a new call queues again
+            assert utils.claim_task(a, json.loads(utils.get_task(a))['key'])
+            task_ids.append(coalesce_task.delay(app_name).key)
+            assert task_ids[-1] != a
+            # a newer call replaces the pending one
+            old = supersede_task.delay(app_name, 'old').key
+            new = supersede_task.delay(app_name, 'new').key
+            task_ids.extend([old, new])
+            data = json.loads(utils.get_task(old))
+            assert data['status'] == 'superseded'
+            assert data['result'] == new
+            rv = queue.DelayedResult(old)
+            rv.wait(0)
+            assert rv.key == new
+            assert new in [json.loads(x)['task_id'] for x in utils.get_pending_tasks(limit=None)]
+            assert old not in [json.loads(x)['task_id'] for x in utils.get_pending_tasks(limit=None)]
+            # cancelling drops the key
+            assert utils.cancel_task(new)
+            task_ids.append(supersede_task.delay(app_name, 'newer').key)
+            assert json.loads(utils.get_task(task_ids[-1]))['status'] == 'new'
+        finally:
+            for lane in settings.QUEUE_LANES:
+                lane_key = utils.get_queue_lane_key(lane)
+                for msg in db.lrange(lane_key, 0, -1):
+                    if queue.decode_task(msg)['id'] in task_ids:
+                        db.lrem(lane_key, msg)
+            for task_id in task_ids:
+                utils.cancel_task(task_id)
+                utils.claim_task(task_id)
+                utils.delete_task_result(task_id)
+
+    def test_task_envelope(self):
+        msg = queue.encode_task('sleep_task', 'abc', (1,), {'x': 'y'}, 'high')
+        data = json.loads(msg)
+        assert data['v'] == queue.ENVELOPE_VERSION
+        assert data['task'] == 'sleep_task'
+        assert data['args'] == [1]
+        assert data['retries'] == 0
+        assert queue.TASKS['sleep_task'] == sleep_task
+        # tasks queued by older versions
+        legacy = queue.decode_task(pickle.dumps((sleep_task, 'abc', (1,), {})))
+        assert legacy['task'] == 'sleep_task'
+        assert legacy['lane'] == settings.QUEUE_DEFAULT_LANE
+
+    def test_priority_lanes(self):
+        db = application.get_db_connection()
+        processing_key = schema.WORKER_PROCESSING_KEY.format(get_random_string())
+        task_ids = [sleep_task.delay(0, priority=x).key for x in ('low', None, 'high')]
+        try:
+            taken = []
+            while True:
+                msg = queue.dequeue(db, processing_key, timeout=1)
+                if msg is None:
+                    break
+                taken.append(queue.decode_task(msg)['id'])
+                utils.claim_task(taken[-1])
+            # highest lane first
+            assert [x for x in taken if x in task_ids] == task_ids[::-1]
+            # lower lanes get a turn
+            assert queue._get_lanes(0)[0] == 'high'
+            assert queue._get_lanes(settings.QUEUE_LANE_FAIRNESS - 1)[0] == 'default'
+            assert queue._get_lanes(settings.QUEUE_LANE_FAIRNESS * 2 - 1)[0] == 'low'
+            self.assertRaises(ValueError, sleep_task.delay, 0, priority='bogus')
+        finally:
+            db.delete(processing_key)
+
 class UtilsTestCase(unittest.TestCase):
     def setUp(self):
         self.db = application.get_db_connection()
@@ -168,15 +754,233 @@ class UtilsTestCase(unittest.TestCase):
         port = utils.get_next_application_port()
         assert port != None
         utils.reserve_application_port(port)
-        ports_key = schema.PORTS_KEY
-        ports = json.loads(self.db.get(ports_key))
-        assert port in ports
+        assert utils.is_application_port_reserved(port)
+        self.assertRaises(RuntimeError, utils.reserve_application_port, port)
         # cleanup
         utils.release_application_port(port)
-        ports = self.db.get(ports_key)
-        if ports:
-            ports = json.loads(ports)
-            assert port not in ports
+        assert not utils.is_application_port_reserved(port)
+
+    def test_reserve_app_ports(self):
+        occupancy = utils.get_port_occupancy()
+        ports = utils.reserve_application_ports(3)
+        assert len(set(ports)) == 3
+        for port in ports:
+            assert settings.APP_MIN_PORT <= port <= settings.APP_MAX_PORT
+            assert utils.is_application_port_reserved(port)
+        assert utils.get_port_occupancy()['reserved'] == occupancy['reserved'] + 3
+        # cleanup
+        for port in ports:
+            utils.release_application_port(port)
+        assert utils.get_port_occupancy()['reserved'] == occupancy['reserved']
+
+    def test_application_config_index(self):
+        tmp_app_name = get_random_string()
+        assert utils.update_application_config(tmp_app_name, {'version': 'test'})
+        assert tmp_app_name in utils.get_applications()
+        assert utils.get_application_config(tmp_app_name)['version'] == 'test'
+        assert utils.remove_application_config(tmp_app_name)
+        assert tmp_app_name not in utils.get_applications()
+        assert utils.get_application_config(tmp_app_name) == None
+
+    def test_index_migration(self):
+        db = application.get_db_connection()
+        tmp_app_name = get_random_string()
+        utils.update_application_config(tmp_app_name, {'version': 'test'})
+        try:
+            # indexes are in place
+            assert not utils.migrate_legacy_indexes()
+            # records from before the indexes
+            db.delete(schema.APPS_INDEX_KEY)
+            assert utils.migrate_legacy_indexes()
+            assert tmp_app_name in utils.get_applications()
+        finally:
+            utils.remove_application_config(tmp_app_name)
+
+    def test_application_config_fields(self):
+        tmp_app_name = get_random_string()
+        utils.update_application_config(tmp_app_name, {'version': '1', 'runtime': 'python', \
+            'instances': {settings.NODE_NAME: [1], 'other-node': [2]}})
+        # partial update leaves other fields alone
+        utils.update_application_config(tmp_app_name, {'version': '2'})
+        utils.set_application_instances(tmp_app_name, [3])
+        app_config = utils.get_application_config(tmp_app_name)
+        assert app_config['version'] == '2'
+        assert app_config['runtime'] == 'python'
+        assert app_config['instances'] == {settings.NODE_NAME: [3], 'other-node': [2]}
+        assert utils.get_application_instances(tmp_app_name) == [3]
+        app_config = utils.get_application_config(tmp_app_name, ['version', 'instances'])
+        assert app_config == {'version': '2', 'instances': {settings.NODE_NAME: [3]}}
+        # cleanup
+        utils.remove_application_config(tmp_app_name)
+
+    def test_application_config_cache(self):
+        tmp_app_name = get_random_string()
+        utils.update_application_config(tmp_app_name, {'version': '1'})
+        # wait for the invalidation listener
+        for i in range(50):
+            utils.get_application_config(tmp_app_name)
+            if utils.app_config_cache.get_stats()['connected']:
+                break
+            time.sleep(0.1)
+        assert utils.get_application_config(tmp_app_name)['version'] == '1'
+        hits = utils.app_config_cache.get_stats()['hits']
+        assert utils.get_application_config(tmp_app_name)['version'] == '1'
+        assert utils.app_config_cache.get_stats()['hits'] == hits + 1
+        # writes invalidate
+        utils.update_application_config(tmp_app_name, {'version': '2'})
+        assert utils.get_application_config(tmp_app_name)['version'] == '2'
+        # cached copies are not shared with callers
+        utils.get_application_config(tmp_app_name)['version'] = '3'
+        assert utils.get_application_config(tmp_app_name)['version'] == '2'
+        utils.remove_application_config(tmp_app_name)
+        assert utils.get_application_config(tmp_app_name) == None
+
+    def test_get_application_configs(self):
+        apps = [get_random_string() for x in range(3)]
+        for app in apps:
+            utils.update_application_config(app, {'version': app})
+        configs = utils.get_application_configs(apps + ['missing-app'])
+        for app in apps:
+            assert configs[app]['version'] == app
+        assert configs['missing-app'] == None
+        # cleanup
+        for app in apps:
+            utils.remove_application_config(app)
+
+    def test_task_result_index(self):
+        task_id = get_random_string()
+        assert utils.set_task_result(task_id, {'task_id': task_id, 'status': 'complete'})
+        assert task_id in [json.loads(x)['task_id'] for x in utils.get_task_results()]
+        assert utils.delete_task_result(task_id)
+        assert utils.get_task(task_id) == None
+        assert task_id not in [json.loads(x)['task_id'] for x in utils.get_task_results()]
+
+    def test_pending_task_registry(self):
+        db = application.get_db_connection()
+        app_name = get_random_string()
+        task_id = sleep_task.delay(app_name).key
+        try:
+            data = json.loads(utils.get_task(task_id))
+            assert data['status'] == 'new'
+            assert data['task'] == 'sleep_task'
+            assert data['application'] == app_name
+            pending = [json.loads(x)['task_id'] for x in utils.get_pending_tasks(limit=None)]
+            assert task_id in pending
+            assert utils.get_pending_task_count() >= 1
+            assert utils.cancel_task(task_id)
+            assert not utils.cancel_task(task_id)
+            assert utils.get_task(task_id) == None
+            # the queued message is skipped by the worker
+            assert not utils.claim_task(task_id)
+        finally:
+            db.lrem(settings.TASK_QUEUE_NAME, [x for x in \
+                db.lrange(settings.TASK_QUEUE_NAME, 0, -1) \
+                if queue.decode_task(x)['id'] == task_id][0])
+
+    def test_task_result_output(self):
+        task_id = get_random_string()
+        output = dict(('step{0}'.format(x), get_random_string() * 1000) for x in range(10))
+        result = json.dumps({'status': 'complete', 'output': output})
+        data = {'task_id': task_id, 'status': 'complete', 'result': result}
+        try:
+            utils.set_task_result(task_id, data)
+            record = json.loads(utils.get_task(task_id))
+            assert record['size'] == len(result)
+            assert record['chunks'] > 0
+            summary = json.loads(record['result'])
+            assert summary['status'] == 'complete'
+            assert len(summary['output']['step0']) <= settings.TASK_RESULT_SUMMARY_SIZE + 3
+            assert utils.get_task_output(task_id) == result
+            assert queue.DelayedResult(task_id).return_value['output'] == output
+            # small results are stored inline
+            utils.set_task_result(task_id, {'task_id': task_id, 'status': 'complete', \
+                'result': 'ok'})
+            assert 'chunks' not in json.loads(utils.get_task(task_id))
+            assert utils.get_task_output(task_id) == 'ok'
+        finally:
+            utils.delete_task_result(task_id)
+
+    def test_log_handler(self):
+        message = get_random_string()
+        log = logging.getLogger(get_random_string())
+        log.addHandler(application.redis_handler)
+        log.error(message)
+        application.redis_handler.flush()
+        logs, cursor = utils.get_logs(category=log.name)
+        assert [x['message'] for x in logs] == [message]
+        stats = application.redis_handler.get_stats()
+        assert stats['buffered'] == 0
+        assert stats['written'] > 0
+
+    def test_log_buffer_overflow(self):
+        from utils.log import RedisHandler
+        handler = RedisHandler(capacity=3, batch_size=100, flush_interval=60)
+        log = logging.getLogger(get_random_string())
+        log.setLevel(logging.DEBUG)
+        log.addHandler(handler)
+        try:
+            log.error('error0')
+            for i in range(5):
+                log.debug('debug{0}'.format(i))
+            # the oldest debug records make room, the error stays
+            assert [x['message'] for x in handler._buffer] == ['error0', 'debug3', 'debug4']
+            for i in range(1, 4):
+                log.error('error{0}'.format(i))
+            # full of errors -- the last one is written right away
+            assert [x['message'] for x in handler._buffer] == ['error0', 'error1', 'error2']
+            assert handler.get_stats()['written'] == 1
+            handler.flush()
+            logs, cursor = utils.get_logs(category=log.name)
+            assert sorted(x['message'] for x in logs) == ['error0', 'error1', 'error2', 'error3']
+            assert handler.get_stats()['dropped'] == 5
+        finally:
+            log.removeHandler(handler)
+            handler.close()
+
+    def test_log_pagination(self):
+        category = get_random_string()
+        log = logging.getLogger(category)
+        log.addHandler(application.redis_handler)
+        for i in range(5):
+            log.warn(str(i))
+        log.debug('debug')
+        application.redis_handler.flush()
+        logs, cursor = utils.get_logs(limit=2, category=category, level=logging.WARN)
+        assert [x['message'] for x in logs] == ['4', '3']
+        logs, cursor = utils.get_logs(cursor=cursor, limit=2, category=category, level=logging.WARN)
+        assert [x['message'] for x in logs] == ['2', '1']
+        logs, cursor = utils.get_logs(cursor=cursor, limit=2, category=category, level=logging.WARN)
+        assert [x['message'] for x in logs] == ['0']
+        assert cursor == None
+        # unparseable filters fall back to the defaults
+        logs, cursor = utils.get_logs(cursor='x', limit='x', category=category, level='x')
+        assert [x['message'] for x in logs] == ['4', '3', '2', '1', '0']
+
+    def test_log_rate_limit(self):
+        from utils.log import RateLimitFilter
+        log_filter = RateLimitFilter({'default': {'sample': 5, 'rate': 1, 'burst': 3}})
+        def record(level):
+            return logging.LogRecord('test', level, __file__, 0, 'message', None, None)
+        kept = [log_filter.filter(record(logging.DEBUG)) for x in range(10)]
+        # 1 in 5 sampled: records 0 and 5 pass sampling, both fit in the bucket
+        assert kept.count(True) == 2
+        kept = [log_filter.filter(record(logging.INFO)) for x in range(10)]
+        # one token left in the bucket
+        assert kept.count(True) == 1
+        # warnings and errors always pass
+        assert all(log_filter.filter(record(logging.ERROR)) for x in range(10))
+        stats = log_filter.get_stats()['test']
+        assert stats['sampled'] == 8
+        assert stats['rate_limited'] == 9
+
+    def test_connection_pool(self):
+        db = application.get_db_connection()
+        assert db.connection_pool is self.db.connection_pool
+        db.ping()
+        stats = pool.get_pool_stats()
+        assert stats['created_connections'] > 0
+        assert stats['available_connections'] > 0
+        assert stats['max_connections'] == settings.DB_MAX_CONNECTIONS
 
     def tearDown(self):
         pass
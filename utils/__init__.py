@@ -1,8 +1,13 @@
 import hashlib
-from random import Random
+import math
+import time
+import uuid
+import zlib
+from redis.exceptions import ResponseError
 import schema
 import application
 import settings
+from utils.cache import app_config_cache, user_cache
 try:
     import simplejson as json
 except ImportError:
@@ -16,7 +21,11 @@ def create_user(username=None, email=None, password=None, role=None, enabled=Tru
     data = schema.user(username=username, email=email, \
         password=encrypt_password(password, settings.SECRET_KEY), \
         role=role, enabled=enabled)
-    db.set(user_key, json.dumps(data))
+    pipe = db.pipeline()
+    pipe.set(user_key, json.dumps(data))
+    pipe.sadd(schema.USERS_INDEX_KEY, username)
+    pipe.execute()
+    user_cache.invalidate_user(username)
     return True
 
 def get_user(username=None):
@@ -31,16 +40,27 @@ def delete_user(username=None):
         raise NameError('You must specify a username')
     db = application.get_db_connection()
     user_key = schema.USER_KEY.format(username)
-    db.delete(user_key)
+    pipe = db.pipeline()
+    pipe.delete(user_key)
+    pipe.srem(schema.USERS_INDEX_KEY, username)
+    pipe.execute()
+    user_cache.invalidate_user(username)
     return True
 
+def get_users():
+    db = application.get_db_connection()
+    return _get_indexed_records(db, schema.USERS_INDEX_KEY, schema.USER_KEY)
+
 def create_role(rolename=None):
     if not rolename:
         raise NameError('You must specify a rolename')
     db = application.get_db_connection()
     role_key = schema.ROLE_KEY.format(rolename)
     data = schema.role(rolename)
-    db.set(role_key, json.dumps(data))
+    pipe = db.pipeline()
+    pipe.set(role_key, json.dumps(data))
+    pipe.sadd(schema.ROLES_INDEX_KEY, rolename)
+    pipe.execute()
     return True
 
 def get_role(rolename=None):
@@ -55,9 +75,16 @@ def delete_role(rolename=None):
         raise NameError('You must specify a rolename')
     db = application.get_db_connection()
     role_key = schema.ROLE_KEY.format(rolename)
-    db.delete(role_key)
+    pipe = db.pipeline()
+    pipe.delete(role_key)
+    pipe.srem(schema.ROLES_INDEX_KEY, rolename)
+    pipe.execute()
     return True
 
+def get_roles():
+    db = application.get_db_connection()
+    return _get_indexed_records(db, schema.ROLES_INDEX_KEY, schema.ROLE_KEY)
+
 def toggle_user(username=None, enabled=None):
     if not username:
         raise NameError('You must specify a username')
@@ -76,6 +103,7 @@ def toggle_user(username=None, enabled=None):
                 enabled = True
             user_data['enabled'] = enabled
         db.set(user_key, json.dumps(user_data))
+        user_cache.invalidate_user(username)
         return True
     else:
         raise RuntimeError('User not found')
@@ -86,91 +114,856 @@ def encrypt_password(password=None, salt=None):
     return h.hexdigest()
 
 def get_task(task_id=None):
+    """
+    Returns the result of a task or, while it is queued, its pending record
+
+    """
+    if not task_id:
+       raise NameError('You must specify a task id')
+    db = application.get_db_connection()
+    task_key = schema.TASK_KEY.format(task_id)
+    pipe = db.pipeline(transaction=False)
+    pipe.get(task_key)
+    pipe.hget(schema.PENDING_TASKS_KEY, task_id)
+    result, pending = pipe.execute()
+    return result if result is not None else pending
+
+# queues a task and registers it as pending.  With a coalescing key
+# (ARGV[5]) an identical pending task is returned instead ('coalesce') or
+# cancelled in favour of the new one ('supersede').
+ADD_PENDING_TASK_SCRIPT = """
+local superseded = ''
+if ARGV[5] ~= '' then
+    local current = redis.call('HGET', KEYS[5], ARGV[5])
+    if current and redis.call('HEXISTS', KEYS[1], current) == 1 then
+        if ARGV[6] ~= 'supersede' then
+            redis.call('HINCRBY', KEYS[8], 'coalesced:' .. ARGV[9], 1)
+            return {current, ''}
+        end
+        redis.call('HDEL', KEYS[1], current)
+        redis.call('ZREM', KEYS[2], current)
+        redis.call('SADD', KEYS[6], current)
+        redis.call('HINCRBY', KEYS[8], 'superseded:' .. ARGV[9], 1)
+        superseded = current
+    end
+    redis.call('HSET', KEYS[5], ARGV[5], ARGV[1])
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+if ARGV[8] ~= '' then
+    -- delayed: wait in the schedule
+    redis.call('ZADD', KEYS[7], ARGV[8], ARGV[4])
+else
+    redis.call('LPUSH', KEYS[3], ARGV[4])
+    redis.call('LPUSH', KEYS[4], 1)
+    redis.call('LTRIM', KEYS[4], 0, ARGV[7] - 1)
+end
+redis.call('HINCRBY', KEYS[8], 'enqueued:' .. ARGV[9], 1)
+return {ARGV[1], superseded}
+"""
+
+def add_pending_task(msg=None, data={}, key=None, supersede=False, \
+    max_signals=100):
+    """
+    Queues a task (``msg``) on its lane (or in the schedule when the
+    record has an ``eta``) and registers it as pending
+
+    Returns a (task id, superseded task id) tuple -- the task id is the one
+    of an identical pending task when it was coalesced.
+
+    :keyword data: Pending record (``schema.task``)
+    :keyword key: (optional) Coalescing key
+    :keyword supersede: Cancels a pending task with the same key instead of
+        coalescing with it
+
+    """
+    db = application.get_db_connection()
+    eta = data.get('eta')
+    task_id, superseded = db.execute_command('EVAL', ADD_PENDING_TASK_SCRIPT, 8, \
+        schema.PENDING_TASKS_KEY, schema.PENDING_TASKS_INDEX_KEY, \
+        get_queue_lane_key(data.get('lane')), schema.TASK_SIGNAL_KEY, \
+        schema.PENDING_TASK_KEYS_KEY, schema.TASK_CANCELLED_KEY, schema.TASK_SCHEDULE_KEY, \
+        schema.TASK_METRICS_KEY, \
+        data['task_id'], json.dumps(data), _format_score(data['date']), msg, key or '', \
+        'supersede' if supersede else 'coalesce', max_signals, \
+        _format_score(eta) if eta else '', data.get('task'))
+    if superseded:
+        set_task_result(superseded, {'date': time.time(), 'task_id': superseded, \
+            'status': 'superseded', 'result': task_id}, settings.TASK_QUEUE_KEY_TTL)
+    return task_id, superseded or None
+
+# moves due tasks (at most ARGV[2]) from the schedule onto their lanes
+# (KEYS[3..] for the lane names in ARGV[3..]) and wakes the workers
+PROMOTE_TASKS_SCRIPT = """
+local lanes = {}
+for i = 3, #ARGV do
+    lanes[ARGV[i]] = KEYS[i]
+end
+local msgs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for i, msg in ipairs(msgs) do
+    redis.call('ZREM', KEYS[1], msg)
+    local lane = lanes[cjson.decode(msg)['lane']] or lanes[ARGV[3]]
+    redis.call('LPUSH', lane, msg)
+    redis.call('LPUSH', KEYS[2], 1)
+end
+return #msgs
+"""
+
+def promote_scheduled_tasks(limit=settings.QUEUE_SCHEDULE_BATCH):
+    """
+    Moves delayed tasks that are due onto their lanes
+
+    Returns the number of tasks moved
+
+    """
+    db = application.get_db_connection()
+    # the default lane goes first -- it is used for unknown lanes
+    lanes = [settings.QUEUE_DEFAULT_LANE] + \
+        [x for x in settings.QUEUE_LANES if x != settings.QUEUE_DEFAULT_LANE]
+    keys = [schema.TASK_SCHEDULE_KEY, schema.TASK_SIGNAL_KEY] + \
+        [get_queue_lane_key(x) for x in lanes]
+    return db.execute_command('EVAL', PROMOTE_TASKS_SCRIPT, len(keys), *(keys + \
+        [_format_score(time.time()), limit] + lanes))
+
+def get_next_scheduled_task_eta():
+    """
+    Returns the eta of the next delayed task (or None)
+
+    """
+    db = application.get_db_connection()
+    tasks = db.zrange(schema.TASK_SCHEDULE_KEY, 0, 0, withscores=True)
+    return tasks[0][1] if tasks else None
+
+def get_pending_tasks(offset=0, limit=settings.TASK_PAGE_SIZE):
+    """
+    Returns a page of pending tasks (oldest first)
+
+    :keyword offset: Number of tasks to skip
+    :keyword limit: Page size (``None`` returns all)
+
+    """
+    db = application.get_db_connection()
+    end = offset + limit - 1 if limit else -1
+    task_ids = db.zrange(schema.PENDING_TASKS_INDEX_KEY, offset, end)
+    if not task_ids:
+        return []
+    records = []
+    for task_id, data in zip(task_ids, db.hmget(schema.PENDING_TASKS_KEY, task_ids)):
+        if data is None:
+            # claimed by a worker in the meantime
+            continue
+        records.append(data)
+    return records
+
+def get_pending_task_count():
+    db = application.get_db_connection()
+    return db.zcard(schema.PENDING_TASKS_INDEX_KEY)
+
+# removes a pending task and marks it so the worker that takes it off the
+# queue skips it (does nothing once a worker claimed it) and wakes waiters
+CANCEL_TASK_SCRIPT = """
+local data = redis.call('HGET', KEYS[1], ARGV[1])
+if data then
+    local key = cjson.decode(data)['key']
+    if type(key) == 'string' and redis.call('HGET', KEYS[5], key) == ARGV[1] then
+        redis.call('HDEL', KEYS[5], key)
+    end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('SADD', KEYS[3], ARGV[1])
+    redis.call('LPUSH', KEYS[4], 1)
+    redis.call('EXPIRE', KEYS[4], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+def cancel_task(task_id=None):
+    """
+    Cancels a pending task
+
+    Returns False if the task is not pending (running or finished)
+
+    """
+    if not task_id:
+       raise NameError('You must specify a task id')
+    db = application.get_db_connection()
+    return db.execute_command('EVAL', CANCEL_TASK_SCRIPT, 5, schema.PENDING_TASKS_KEY, \
+        schema.PENDING_TASKS_INDEX_KEY, schema.TASK_CANCELLED_KEY, \
+        schema.TASK_DONE_KEY.format(task_id), schema.PENDING_TASK_KEYS_KEY, task_id, \
+        settings.TASK_QUEUE_KEY_TTL) == 1
+
+# removes a task from the pending registry (and its coalescing key unless
+# a newer task took it over); returns 1 if the task was cancelled
+CLAIM_TASK_SCRIPT = """
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+if ARGV[2] ~= '' and redis.call('HGET', KEYS[4], ARGV[2]) == ARGV[1] then
+    redis.call('HDEL', KEYS[4], ARGV[2])
+end
+return redis.call('SREM', KEYS[3], ARGV[1])
+"""
+
+def claim_task(task_id=None, key=None):
+    """
+    Removes a task from the pending registry as a worker starts it
+
+    Returns False if the task was cancelled
+
+    :keyword key: (optional) Coalescing key of the task
+
+    """
+    db = application.get_db_connection()
+    return not db.execute_command('EVAL', CLAIM_TASK_SCRIPT, 4, schema.PENDING_TASKS_KEY, \
+        schema.PENDING_TASKS_INDEX_KEY, schema.TASK_CANCELLED_KEY, \
+        schema.PENDING_TASK_KEYS_KEY, task_id, key or '')
+
+def delete_pending_tasks():
+    db = application.get_db_connection()
+    pipe = db.pipeline()
+    for lane in settings.QUEUE_LANES:
+        pipe.delete(get_queue_lane_key(lane))
+    pipe.delete(schema.PENDING_TASKS_KEY)
+    pipe.delete(schema.PENDING_TASKS_INDEX_KEY)
+    pipe.delete(schema.PENDING_TASK_KEYS_KEY)
+    pipe.delete(schema.TASK_SCHEDULE_KEY)
+    pipe.delete(schema.TASK_CANCELLED_KEY)
+    pipe.execute()
+    return True
+
+def set_task_result(task_id=None, data={}, ttl=None):
+    """
+    Stores the result of a task
+
+    Results longer than ``TASK_RESULT_SUMMARY_SIZE`` are stored as a
+    summary; the full output is kept compressed in chunks (see
+    ``get_task_output``).
+
+    """
+    if not task_id:
+       raise NameError('You must specify a task id')
+    db = application.get_db_connection()
+    task_key = schema.TASK_KEY.format(task_id)
+    output_key = schema.TASK_OUTPUT_KEY.format(task_id)
+    data = dict(data)
+    result = data.get('result')
+    pipe = db.pipeline()
+    pipe.delete(output_key)
+    if isinstance(result, basestring) and len(result) > settings.TASK_RESULT_SUMMARY_SIZE:
+        if isinstance(result, unicode):
+            result = result.encode('utf-8')
+        data['result'] = _summarize_task_result(result)
+        data['size'] = len(result)
+        if len(result) > settings.TASK_RESULT_MAX_SIZE:
+            result = result[:settings.TASK_RESULT_MAX_SIZE]
+            data['truncated'] = True
+        output = zlib.compress(result)
+        chunk_size = settings.TASK_RESULT_CHUNK_SIZE
+        chunks = [output[x:x + chunk_size] for x in range(0, len(output), chunk_size)]
+        data['chunks'] = len(chunks)
+        pipe.rpush(output_key, *chunks)
+        if ttl:
+            pipe.expire(output_key, ttl)
+    pipe.set(task_key, json.dumps(data))
+    if ttl:
+        pipe.expire(task_key, ttl)
+    pipe.zadd(schema.TASKS_INDEX_KEY, task_id, data.get('date') or time.time())
+    if data.get('status') in ('complete', 'error', 'superseded'):
+        # wake up wait_for_task callers
+        done_key = schema.TASK_DONE_KEY.format(task_id)
+        pipe.lpush(done_key, 1)
+        pipe.expire(done_key, ttl or settings.TASK_QUEUE_KEY_TTL)
+    pipe.execute()
+    return True
+
+def _summarize_task_result(result=None):
+    # json results keep their structure with long strings cut
+    size = settings.TASK_RESULT_SUMMARY_SIZE
+    def _summarize(value):
+        if isinstance(value, dict):
+            return dict((k, _summarize(v)) for k, v in value.iteritems())
+        if isinstance(value, list):
+            return [_summarize(x) for x in value]
+        if isinstance(value, basestring) and len(value) > size:
+            return value[:size] + '...'
+        return value
+    try:
+        value = json.loads(result)
+    except ValueError:
+        return _summarize(result)
+    if not isinstance(value, (dict, list)):
+        return _summarize(result)
+    return json.dumps(_summarize(value))
+
+def iter_task_output(task_id=None):
+    """
+    Yields the full output of a task in pieces (one stored chunk at a time)
+
+    """
+    if not task_id:
+       raise NameError('You must specify a task id')
+    data = _load_record(get_task(task_id)) or {}
+    if not data.get('chunks'):
+        if data.get('result') is not None:
+            yield data['result']
+        return
+    db = application.get_db_connection()
+    output_key = schema.TASK_OUTPUT_KEY.format(task_id)
+    decompressor = zlib.decompressobj()
+    for i in range(data['chunks']):
+        chunk = db.lindex(output_key, i)
+        if chunk is None:
+            # expired
+            break
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+def get_task_output(task_id=None):
+    """
+    Returns the full output of a task
+
+    """
+    return ''.join(iter_task_output(task_id))
+
+def add_task_event(task_id=None, event={}):
+    """
+    Appends a progress event to the event stream of a task
+
+    """
+    if not task_id:
+       raise NameError('You must specify a task id')
+    db = application.get_db_connection()
+    events_key = schema.TASK_EVENTS_KEY.format(task_id)
+    pipe = db.pipeline(transaction=False)
+    pipe.execute_command('XADD', events_key, 'MAXLEN', '~', \
+        settings.TASK_EVENTS_MAX_LENGTH, '*', 'data', json.dumps(event))
+    pipe.expire(events_key, settings.TASK_QUEUE_KEY_TTL)
+    return pipe.execute()[0]
+
+def get_task_events(task_id=None, last_id='0', timeout=None, db=None):
+    """
+    Returns a list of (event id, event) tuples of a task after ``last_id``
+
+    :keyword timeout: (optional) Seconds to block for new events (on the
+        blocking pool)
+    :keyword db: (optional) Redis client to read with
+
+    """
+    if not task_id:
+       raise NameError('You must specify a task id')
+    if db is None:
+        db = application.get_blocking_db_connection() if timeout else \
+            application.get_db_connection()
+    args = ['XREAD', 'COUNT', settings.TASK_EVENTS_MAX_LENGTH]
+    if timeout:
+        args.extend(['BLOCK', int(timeout * 1000)])
+    args.extend(['STREAMS', schema.TASK_EVENTS_KEY.format(task_id), last_id])
+    reply = db.execute_command(*args)
+    events = []
+    for key, entries in reply or []:
+        for event_id, fields in entries:
+            fields = dict(zip(fields[::2], fields[1::2]))
+            events.append((event_id, _load_record(fields.get('data')) or {}))
+    return events
+
+def wait_for_task(task_id=None, timeout=None):
+    """
+    Blocks until a task has finished (or was cancelled) and returns it like
+    ``get_task``.  After ``timeout`` seconds the current state is returned.
+
+    :keyword timeout: Seconds to wait (``None`` or 0 does not block)
+
+    Waits use the blocking pool and raise ``pool.PoolExhaustedError`` once
+    ``DB_MAX_BLOCKING_CONNECTIONS`` are waiting.
+
+    """
+    if not task_id:
+       raise NameError('You must specify a task id')
+    task = get_task(task_id)
+    if not timeout or (task is not None and \
+        (_load_record(task) or {}).get('status') not in ('new', 'running', 'retrying')):
+        return task
+    db = application.get_blocking_db_connection()
+    done_key = schema.TASK_DONE_KEY.format(task_id)
+    # pop and push back onto the same list so every waiter sees the
+    # notification
+    db.brpoplpush(done_key, done_key, int(math.ceil(timeout)))
+    return get_task(task_id)
+
+def get_task_results(offset=0, limit=None):
+    """
+    Returns task results (newest first)
+
+    :keyword offset: Number of results to skip
+    :keyword limit: Page size (``None`` returns all)
+
+    """
+    db = application.get_db_connection()
+    # results expire on their own -- drop index entries older than the ttl
+    db.zremrangebyscore(schema.TASKS_INDEX_KEY, 0, \
+        time.time() - settings.TASK_QUEUE_KEY_TTL)
+    end = offset + limit - 1 if limit else -1
+    task_ids = db.zrevrange(schema.TASKS_INDEX_KEY, offset, end)
+    return _get_records(db, schema.TASKS_INDEX_KEY, schema.TASK_KEY, task_ids, \
+        zset=True)
+
+def delete_task_result(task_id=None):
     if not task_id:
        raise NameError('You must specify a task id')
     db = application.get_db_connection()
-    task_key = '{0}:{1}'.format(settings.TASK_QUEUE_NAME, task_id)
-    return db.get(task_key)
+    pipe = db.pipeline()
+    pipe.delete(schema.TASK_KEY.format(task_id))
+    pipe.zrem(schema.TASKS_INDEX_KEY, task_id)
+    pipe.delete(schema.TASK_DONE_KEY.format(task_id))
+    pipe.delete(schema.TASK_OUTPUT_KEY.format(task_id))
+    pipe.delete(schema.TASK_EVENTS_KEY.format(task_id))
+    res = pipe.execute()
+    return res[0] > 0
+
+def delete_task_results():
+    db = application.get_db_connection()
+    task_ids = db.zrange(schema.TASKS_INDEX_KEY, 0, -1)
+    pipe = db.pipeline()
+    for task_id in task_ids:
+        pipe.delete(schema.TASK_KEY.format(task_id))
+        pipe.delete(schema.TASK_DONE_KEY.format(task_id))
+        pipe.delete(schema.TASK_OUTPUT_KEY.format(task_id))
+        pipe.delete(schema.TASK_EVENTS_KEY.format(task_id))
+    pipe.delete(schema.TASKS_INDEX_KEY)
+    pipe.execute()
+    return True
+
+def get_queue_lane_key(lane=None):
+    """
+    Returns the list key of a priority lane
+
+    :keyword lane: Lane name (default ``QUEUE_DEFAULT_LANE``)
+
+    """
+    lane = lane or settings.QUEUE_DEFAULT_LANE
+    if lane not in settings.QUEUE_LANES:
+        raise ValueError('Unknown queue lane: {0}'.format(lane))
+    if lane == settings.QUEUE_DEFAULT_LANE:
+        return settings.TASK_QUEUE_NAME
+    return schema.TASK_LANE_KEY.format(lane)
+
+def get_queue_depths():
+    """
+    Returns a list of (lane, pending tasks) tuples, highest lane first
+
+    """
+    db = application.get_db_connection()
+    pipe = db.pipeline(transaction=False)
+    for lane in settings.QUEUE_LANES:
+        pipe.llen(get_queue_lane_key(lane))
+    return zip(settings.QUEUE_LANES, pipe.execute())
 
-def get_application_config(app=None):
-    if not application:
+def get_logs(cursor=None, limit=settings.LOG_PAGE_SIZE, level=None, category=None, \
+    start=None, end=None):
+    """
+    Returns a page of logs (newest first) and the cursor for the next page
+
+    :keyword cursor: (optional) Cursor returned by the previous page
+    :keyword limit: (optional) Page size
+    :keyword level: (optional) Minimum log level
+    :keyword category: (optional) Log category
+    :keyword start: (optional) Oldest timestamp to return
+    :keyword end: (optional) Newest timestamp to return
+
+    """
+    db = application.get_db_connection()
+    # filters come straight from the request -- unparseable ones are ignored
+    limit = _parse_number(limit, int, settings.LOG_PAGE_SIZE)
+    if limit < 1:
+        limit = settings.LOG_PAGE_SIZE
+    level = _parse_number(level, int)
+    start = _parse_number(start, float)
+    end = _parse_number(end, float)
+    max_score = end if end is not None else '+inf'
+    min_score = start if start is not None else '-inf'
+    # the cursor is the score of the last record returned and how many
+    # records with that score were already seen
+    skip = 0
+    if cursor:
+        try:
+            max_score, skip = cursor.split(',')
+            max_score, skip = float(max_score), max(0, int(skip))
+        except ValueError:
+            max_score, skip = end if end is not None else '+inf', 0
+    # filtered pages may need more than one chunk
+    chunk_size = limit if not (level or category) else limit * 4
+    logs = []
+    exhausted = False
+    while len(logs) < limit:
+        chunk = db.zrevrangebyscore(schema.LOGS_KEY, _format_score(max_score), \
+            min_score, start=skip, num=chunk_size, withscores=True)
+        for data, score in chunk:
+            if score == max_score:
+                skip += 1
+            else:
+                max_score, skip = score, 1
+            data = _load_record(data)
+            if not data:
+                continue
+            if level and data['level'] < level:
+                continue
+            if category and data['category'] != category:
+                continue
+            logs.append(data)
+            if len(logs) == limit:
+                break
+        if len(chunk) < chunk_size:
+            exhausted = True
+            break
+    next_cursor = None
+    if not exhausted and logs:
+        next_cursor = '{0!r},{1}'.format(max_score, skip)
+    return logs, next_cursor
+
+def clear_logs():
+    db = application.get_db_connection()
+    try:
+        # UNLINK frees the memory in the background
+        db.execute_command('UNLINK', schema.LOGS_KEY)
+    except ResponseError:
+        db.delete(schema.LOGS_KEY)
+    return True
+
+def migrate_legacy_logs():
+    """
+    Moves logs stored as one key per record into the log store
+
+    """
+    db = application.get_db_connection()
+    keys = list(scan_keys(schema.LEGACY_LOG_KEY.format('*')))
+    for i in range(0, len(keys), 1000):
+        chunk = keys[i:i + 1000]
+        pipe = db.pipeline()
+        for data in db.mget(chunk):
+            data = _load_record(data)
+            if data:
+                data.setdefault('id', uuid.uuid4().hex)
+                pipe.zadd(schema.LOGS_KEY, json.dumps(data), repr(data['date']))
+        pipe.delete(*chunk)
+        pipe.execute()
+    db.delete(schema.LEGACY_LOGS_INDEX_KEY)
+    return True
+
+def _encode_application_config(config={}):
+    """
+    Flattens an application config into hash fields
+
+    Every value is stored JSON encoded and ``instances`` is split into one
+    field per node so a node can update its instances on its own
+
+    """
+    fields = {}
+    for k, v in config.iteritems():
+        if k == 'instances':
+            for node, instances in (v or {}).iteritems():
+                fields[schema.APP_INSTANCES_FIELD.format(node)] = json.dumps(instances)
+        else:
+            fields[k] = json.dumps(v)
+    return fields
+
+def _decode_application_config(fields={}):
+    if not fields:
+        return None
+    config = {}
+    instances_prefix = schema.APP_INSTANCES_FIELD.format('')
+    for k, v in fields.iteritems():
+        if v is None:
+            continue
+        v = json.loads(v)
+        if k.startswith(instances_prefix):
+            config.setdefault('instances', {})[k[len(instances_prefix):]] = v
+        else:
+            config[k] = v
+    return config
+
+def _get_application_config_fields(fields=[]):
+    # ``instances`` only resolves the instances of this node
+    return [schema.APP_INSTANCES_FIELD.format(settings.NODE_NAME) \
+        if x == 'instances' else x for x in fields]
+
+def _filter_application_config(config=None, fields=None):
+    if not config or not fields:
+        return config
+    res = {}
+    for k in fields:
+        if k == 'instances':
+            instances = config.get('instances', {})
+            if settings.NODE_NAME in instances:
+                res['instances'] = {settings.NODE_NAME: instances[settings.NODE_NAME]}
+        elif k in config:
+            res[k] = config[k]
+    return res or None
+
+def _get_cached_application_configs(apps=[]):
+    """
+    Returns full application configs from the process cache, fetching the
+    misses (and their version stamps) in a single round trip
+
+    """
+    configs = {}
+    missing = []
+    for app in apps:
+        hit, config = app_config_cache.get(app)
+        if hit:
+            configs[app] = config
+        else:
+            missing.append(app)
+    if missing:
+        db = application.get_db_connection()
+        pipe = db.pipeline()
+        for app in missing:
+            pipe.hgetall(schema.APP_KEY.format(app))
+            pipe.hget(schema.APP_VERSIONS_KEY, app)
+        res = pipe.execute()
+        for i, app in enumerate(missing):
+            config = _decode_application_config(res[i * 2])
+            app_config_cache.set(app, config, int(res[i * 2 + 1] or 0))
+            configs[app] = config
+    return configs
+
+def _publish_application_config_version(db=None, app=None, version=None):
+    app_config_cache.invalidate(app, version)
+    db.publish(settings.CONFIG_CHANNEL, json.dumps({'application': app, 'version': version}))
+
+def get_application_config(app=None, fields=None):
+    """
+    Returns the application config (or None if the application does not exist)
+
+    :keyword app: Application name
+    :keyword fields: (optional) List of fields to fetch (``instances`` returns
+        the instances for this node only)
+
+    """
+    if not app:
         raise NameError('You must specify an application')
+    if settings.APP_CONFIG_CACHE:
+        return _filter_application_config(_get_cached_application_configs([app])[app], fields)
     db = application.get_db_connection()
-    app_key = schema.APP_KEY.format(app, '*')
-    res = db.keys(app_key)
-    if res:
-        app = db.get(res[0])
-    else:
-        app = None
-    return app
+    app_key = schema.APP_KEY.format(app)
+    if fields:
+        fields = _get_application_config_fields(fields)
+        return _decode_application_config(dict(zip(fields, db.hmget(app_key, fields))))
+    return _decode_application_config(db.hgetall(app_key))
+
+def get_application_configs(apps=[], fields=None):
+    """
+    Returns a dict of application name to config for ``apps`` in a single
+    pipelined round trip
+
+    :keyword apps: Application names
+    :keyword fields: (optional) List of fields to fetch
+
+    """
+    apps = list(apps)
+    if not apps:
+        return {}
+    if settings.APP_CONFIG_CACHE:
+        configs = _get_cached_application_configs(apps)
+        return dict((k, _filter_application_config(v, fields)) for k, v in configs.iteritems())
+    db = application.get_db_connection()
+    pipe = db.pipeline(transaction=False)
+    if fields:
+        fields = _get_application_config_fields(fields)
+    for app in apps:
+        if fields:
+            pipe.hmget(schema.APP_KEY.format(app), fields)
+        else:
+            pipe.hgetall(schema.APP_KEY.format(app))
+    configs = {}
+    for app, res in zip(apps, pipe.execute()):
+        if fields:
+            res = dict(zip(fields, res))
+        configs[app] = _decode_application_config(res)
+    return configs
+
+def get_application_instances(app=None, node_name=settings.NODE_NAME):
+    """
+    Returns the instances (ports) of an application on a node
+
+    """
+    if not app:
+        raise NameError('You must specify an application')
+    if settings.APP_CONFIG_CACHE:
+        app_config = _get_cached_application_configs([app])[app]
+        if not app_config:
+            return None
+        return app_config.get('instances', {}).get(node_name)
+    db = application.get_db_connection()
+    instances = db.hget(schema.APP_KEY.format(app), \
+        schema.APP_INSTANCES_FIELD.format(node_name))
+    if instances is None:
+        return None
+    return json.loads(instances)
 
 def update_application_config(app=None, config={}):
-    if not application:
+    """
+    Updates the given fields of the application config
+
+    Fields not present in ``config`` are left untouched
+
+    """
+    if not app:
         raise NameError('You must specify an application')
     db = application.get_db_connection()
-    app_key = schema.APP_KEY.format(app, '')
-    db.set(app_key, json.dumps(config))
+    app_key = schema.APP_KEY.format(app)
+    pipe = db.pipeline()
+    fields = _encode_application_config(config)
+    if fields:
+        pipe.hmset(app_key, fields)
+    pipe.sadd(schema.APPS_INDEX_KEY, app)
+    pipe.hincrby(schema.APP_VERSIONS_KEY, app, 1)
+    version = pipe.execute()[-1]
+    _publish_application_config_version(db, app, version)
     return True
 
+def set_application_instances(app=None, instances=[], node_name=settings.NODE_NAME):
+    return update_application_config(app, {'instances': {node_name: instances}})
+
 def remove_application_config(app=None):
-    if not application:
+    if not app:
         raise NameError('You must specify an application')
     db = application.get_db_connection()
-    app_key = schema.APP_KEY.format(app, '*')
-    res = db.keys(app_key)
-    for k in res:
+    app_key = schema.APP_KEY.format(app)
+    pipe = db.pipeline()
+    pipe.delete(app_key)
+    pipe.srem(schema.APPS_INDEX_KEY, app)
+    pipe.hincrby(schema.APP_VERSIONS_KEY, app, 1)
+    version = pipe.execute()[-1]
+    _publish_application_config_version(db, app, version)
+    return True
+
+def migrate_legacy_application_configs():
+    """
+    Converts JSON string application configs into hashes
+
+    """
+    db = application.get_db_connection()
+    for k in scan_keys(schema.LEGACY_APP_KEY.format('*')):
+        app = k.split(':')[1]
+        config = _load_record(db.get(k))
+        if config:
+            update_application_config(app, config)
         db.delete(k)
     return True
 
-def get_next_application_port():
+def get_applications():
     db = application.get_db_connection()
-    k = schema.PORTS_KEY
-    port = None
-    ports = db.get(k)
-    if not ports:
-        ports = []
-    else:
-        try:
-            ports = json.loads(ports)
-        except:
-            ports = []
-    # generate and make sure port not already used
-    while True:
-        port = Random().randint(settings.APP_MIN_PORT, settings.APP_MAX_PORT)
-        if port not in ports:
-            break
-    return port
+    return db.smembers(schema.APPS_INDEX_KEY)
 
-def reserve_application_port(port=None):
+# reserves ``count`` free ports in the port bitmap (bit offset = port - min port)
+# ARGV: min port, max port, count -- returns nil if not enough ports are free
+RESERVE_PORTS_SCRIPT = """
+local min_port = tonumber(ARGV[1])
+local range = tonumber(ARGV[2]) - min_port
+local count = tonumber(ARGV[3])
+local ports = {}
+local start = 0
+for i = 1, count do
+    local pos = redis.call('BITPOS', KEYS[1], 0, start)
+    if pos == -1 then
+        pos = redis.call('STRLEN', KEYS[1]) * 8
+    end
+    if pos > range then
+        for _, port in ipairs(ports) do
+            redis.call('SETBIT', KEYS[1], port - min_port, 0)
+        end
+        return false
+    end
+    redis.call('SETBIT', KEYS[1], pos, 1)
+    ports[i] = pos + min_port
+    start = math.floor(pos / 8)
+end
+return ports
+"""
+
+def _check_port(port=None):
     if not port:
         raise NameError('You must specify a port')
+    port = int(port)
+    if port < settings.APP_MIN_PORT or port > settings.APP_MAX_PORT:
+        raise ValueError('Port {0} out of range ({1}-{2})'.format(port, \
+            settings.APP_MIN_PORT, settings.APP_MAX_PORT))
+    return port - settings.APP_MIN_PORT
+
+def reserve_application_ports(count=1):
+    """
+    Atomically reserves ``count`` free application ports
+
+    :keyword count: Number of ports to reserve
+
+    """
     db = application.get_db_connection()
-    ports = db.get(schema.PORTS_KEY)
+    ports = db.execute_command('EVAL', RESERVE_PORTS_SCRIPT, 1, schema.PORTS_KEY, \
+        settings.APP_MIN_PORT, settings.APP_MAX_PORT, count)
     if not ports:
-        ports = []
-    else:
-        try:
-            ports = json.loads(ports)
-        except:
-            ports = []
-    if port in ports:
+        raise RuntimeError('Not enough free application ports')
+    return ports
+
+def get_next_application_port():
+    """
+    Returns the next free application port (does not reserve it)
+
+    """
+    db = application.get_db_connection()
+    pos = db.execute_command('BITPOS', schema.PORTS_KEY, 0)
+    if pos > settings.APP_MAX_PORT - settings.APP_MIN_PORT:
+        return None
+    return settings.APP_MIN_PORT + pos
+
+def reserve_application_port(port=None):
+    offset = _check_port(port)
+    db = application.get_db_connection()
+    if db.setbit(schema.PORTS_KEY, offset, 1):
         raise RuntimeError('Port already reserved')
-    ports.append(port)
-    db.set(schema.PORTS_KEY, json.dumps(ports))
     return True
 
 def release_application_port(port=None):
-    if not port:
-        raise NameError('You must specify a port')
+    offset = _check_port(port)
+    db = application.get_db_connection()
+    db.setbit(schema.PORTS_KEY, offset, 0)
+
+def is_application_port_reserved(port=None):
+    offset = _check_port(port)
+    db = application.get_db_connection()
+    return db.getbit(schema.PORTS_KEY, offset) == 1
+
+def get_port_occupancy():
+    """
+    Returns reserved/free application port counts for the node
+
+    """
+    db = application.get_db_connection()
+    total = settings.APP_MAX_PORT - settings.APP_MIN_PORT + 1
+    reserved = db.execute_command('BITCOUNT', schema.PORTS_KEY)
+    return {'total': total, 'reserved': reserved, 'free': total - reserved}
+
+def migrate_legacy_ports():
+    """
+    Moves reservations from the old JSON port list into the port bitmap
+
+    """
     db = application.get_db_connection()
-    ports = db.get(schema.PORTS_KEY)
-    if ports:
+    ports = db.get(schema.LEGACY_PORTS_KEY)
+    if not ports:
+        return False
+    try:
+        ports = json.loads(ports)
+    except:
+        ports = []
+    pipe = db.pipeline()
+    for port in ports:
         try:
-            ports = json.loads(ports)
-            ports.remove(port)
-            db.set(schema.PORTS_KEY, json.dumps(ports))
-        except:
+            pipe.setbit(schema.PORTS_KEY, _check_port(port), 1)
+        except ValueError:
             pass
+    pipe.delete(schema.LEGACY_PORTS_KEY)
+    pipe.execute()
+    return True
 
 def add_app_to_node_app_list(app_name=None):
     if not app_name:
@@ -202,3 +995,111 @@ def get_node_applications(node_name=settings.NODE_NAME):
     db = application.get_db_connection()
     return db.smembers(schema.NODE_APPS_KEY.format(node_name))
 
+
+def scan_keys(pattern=None, count=1000):
+    """
+    Iterates keys matching ``pattern`` using cursor based SCAN
+
+    Only used as a fallback (i.e. rebuilding indexes) -- listings should
+    use the maintained indexes
+
+    """
+    if not pattern:
+        raise NameError('You must specify a pattern')
+    db = application.get_db_connection()
+    cursor = '0'
+    while True:
+        cursor, keys = db.execute_command('SCAN', cursor, 'MATCH', pattern, \
+            'COUNT', count)
+        for k in keys:
+            yield k
+        if cursor == '0':
+            break
+
+def rebuild_indexes():
+    """
+    Rebuilds the secondary indexes from the existing records
+
+    """
+    db = application.get_db_connection()
+    pipe = db.pipeline()
+    pipe.delete(schema.USERS_INDEX_KEY, schema.ROLES_INDEX_KEY, \
+        schema.APPS_INDEX_KEY, schema.TASKS_INDEX_KEY, schema.PENDING_TASKS_INDEX_KEY)
+    for k in scan_keys(schema.USER_KEY.format('*')):
+        pipe.sadd(schema.USERS_INDEX_KEY, k.split(':', 1)[1])
+    for k in scan_keys(schema.ROLE_KEY.format('*')):
+        pipe.sadd(schema.ROLES_INDEX_KEY, k.split(':', 1)[1])
+    for k in scan_keys(schema.APP_KEY.format('*')):
+        pipe.sadd(schema.APPS_INDEX_KEY, k.split(':')[1])
+    task_prefix = schema.TASK_KEY.format('')
+    for k in scan_keys(schema.TASK_KEY.format('*')):
+        data = _load_record(db.get(k))
+        if data:
+            pipe.zadd(schema.TASKS_INDEX_KEY, k[len(task_prefix):], data.get('date') or 0)
+    for task_id, v in db.hgetall(schema.PENDING_TASKS_KEY).iteritems():
+        data = _load_record(v) or {}
+        pipe.zadd(schema.PENDING_TASKS_INDEX_KEY, task_id, data.get('date') or 0)
+    pipe.execute()
+    return True
+
+def migrate_legacy_indexes():
+    """
+    Builds the secondary indexes when records exist without them (data
+    written by versions before the indexes)
+
+    """
+    db = application.get_db_connection()
+    if db.hlen(schema.PENDING_TASKS_KEY) and not db.exists(schema.PENDING_TASKS_INDEX_KEY):
+        return rebuild_indexes()
+    for index_key, key in ((schema.USERS_INDEX_KEY, schema.USER_KEY), \
+        (schema.ROLES_INDEX_KEY, schema.ROLE_KEY), (schema.APPS_INDEX_KEY, schema.APP_KEY), \
+        (schema.TASKS_INDEX_KEY, schema.TASK_KEY)):
+        if not db.exists(index_key) and next(scan_keys(key.format('*')), None) is not None:
+            return rebuild_indexes()
+    return False
+
+def _parse_number(value=None, cast=int, default=None):
+    # request arguments that are not numbers fall back to ``default``
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return default
+
+def _format_score(score=None):
+    # str() truncates floats to 12 digits -- repr keeps the full precision
+    if isinstance(score, float):
+        return repr(score)
+    return score
+
+def _load_record(data=None):
+    try:
+        return json.loads(data)
+    except:
+        return None
+
+def _get_indexed_records(db=None, index_key=None, key=None):
+    return _get_records(db, index_key, key, sorted(db.smembers(index_key)))
+
+def _get_records(db=None, index_key=None, key=None, ids=[], zset=False):
+    """
+    Fetches the records for ``ids`` in a single MGET and prunes index
+    entries whose record no longer exists
+
+    """
+    if not ids:
+        return []
+    records = []
+    missing = []
+    for record_id, data in zip(ids, db.mget([key.format(x) for x in ids])):
+        if data is None:
+            missing.append(record_id)
+        else:
+            records.append(data)
+    if missing:
+        if zset:
+            db.zrem(index_key, *missing)
+        else:
+            db.srem(index_key, *missing)
+    return records
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+import os
+import time
+import copy
+import threading
+import application
+import settings
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+class ApplicationConfigCache(object):
+    """
+    Read-through cache of parsed application configs
+
+    Entries are only served while the invalidation listener is subscribed
+    to ``settings.CONFIG_CHANNEL``.  Every config write bumps a version
+    stamp and publishes it; entries older than the newest version seen
+    for an application are never stored.
+
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._entries = {}
+        self._versions = {}
+        self._connected = False
+        self._listener = None
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'stale': 0,
+        }
+
+    def _ensure_listener(self):
+        # threads do not survive a fork -- start over in the child
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._reset()
+        if self._listener is None:
+            with self._lock:
+                if self._listener is None:
+                    self._listener = threading.Thread(target=self._listen)
+                    self._listener.daemon = True
+                    self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                ps = application.get_db_connection().pubsub()
+                ps.subscribe(settings.CONFIG_CHANNEL)
+                self._connected = True
+                for m in ps.listen():
+                    if m['type'] != 'message':
+                        continue
+                    data = json.loads(m['data'])
+                    self.invalidate(data.get('application'), data.get('version'))
+            except Exception:
+                pass
+            # missed invalidations while disconnected -- drop everything
+            self._connected = False
+            self.clear()
+            time.sleep(1)
+
+    def get(self, app=None):
+        """
+        Returns a (hit, config) tuple
+
+        """
+        if not settings.APP_CONFIG_CACHE:
+            return False, None
+        self._ensure_listener()
+        with self._lock:
+            entry = self._entries.get(app)
+            if entry is not None and self._connected and \
+                (not self.ttl or time.time() - entry['date'] < self.ttl):
+                self._stats['hits'] += 1
+                return True, copy.deepcopy(entry['config'])
+            self._stats['misses'] += 1
+        return False, None
+
+    def set(self, app=None, config=None, version=0):
+        if not settings.APP_CONFIG_CACHE or not self._connected:
+            return False
+        with self._lock:
+            if version < self._versions.get(app, 0):
+                self._stats['stale'] += 1
+                return False
+            self._versions[app] = version
+            self._entries[app] = {
+                'date': time.time(),
+                'version': version,
+                'config': copy.deepcopy(config),
+            }
+        return True
+
+    def invalidate(self, app=None, version=None):
+        with self._lock:
+            if version is not None:
+                self._versions[app] = max(version, self._versions.get(app, 0))
+            self._entries.pop(app, None)
+            self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def get_stats(self):
+        with self._lock:
+            stats = {
+                'connected': self._connected,
+                'entries': len(self._entries),
+            }
+            stats.update(self._stats)
+        return stats
+
+app_config_cache = ApplicationConfigCache(ttl=settings.APP_CONFIG_CACHE_TTL)
+
+class UserCache(object):
+    """
+    Short lived cache of user records keyed by ``auth_token``
+
+    Local changes (toggle, delete, account updates) invalidate right away;
+    other processes pick them up once ``ttl`` expires.
+
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, auth_token=None):
+        if not self.ttl or not auth_token:
+            return None
+        with self._lock:
+            entry = self._entries.get(auth_token)
+            if entry is None:
+                return None
+            if time.time() - entry['date'] >= self.ttl:
+                del self._entries[auth_token]
+                return None
+            return copy.deepcopy(entry['user'])
+
+    def set(self, auth_token=None, user=None):
+        if not self.ttl or not auth_token:
+            return False
+        now = time.time()
+        with self._lock:
+            # drop expired entries so old tokens do not pile up
+            for k, entry in self._entries.items():
+                if now - entry['date'] >= self.ttl:
+                    del self._entries[k]
+            self._entries[auth_token] = {
+                'date': now,
+                'user': copy.deepcopy(user),
+            }
+        return True
+
+    def invalidate(self, auth_token=None):
+        with self._lock:
+            self._entries.pop(auth_token, None)
+
+    def invalidate_user(self, username=None):
+        with self._lock:
+            for auth_token, entry in self._entries.items():
+                if entry['user'].get('username') == username:
+                    del self._entries[auth_token]
+
+user_cache = UserCache(ttl=settings.USER_CACHE_TTL)
@@ -11,20 +11,23 @@ import shutil
 import settings
 import tempfile
 import uuid
-import tarfile
 import utils
-from queue import task
-from utils import config
+from queue import task, step, Retry
+from utils import config, packages, releases, virtualenvs
 try:
     import simplejson as json
 except ImportError:
     import json
 
-@task
+@task(supersede=True, max_retries=settings.DEPLOY_MAX_RETRIES)
 def deploy_app(app_name=None, package=None, build_ve=True, force_rebuild_ve=False):
     """
     Deploys application
 
+    Failed clones and dependency installs (usually network errors) are
+    retried up to ``DEPLOY_MAX_RETRIES`` times; ``deploy_app.delay`` takes
+    ``max_retries`` to change that.
+
     :keyword app_name: Name of application to deploy
     :keyword package: Package to deploy (as tar.gz)
     :keyword build_ve: Builds virtualenv for app
@@ -35,13 +38,13 @@ def deploy_app(app_name=None, package=None, build_ve=True, force_rebuild_ve=Fals
     log.info('Deploying package {0}'.format(package))
     errors = {}
     output = {}
-    tmp_deploy_dir = tempfile.mkdtemp()
-    # extract
+    release = None
+    # extract (once per package contents -- redeploys and rollbacks reuse it)
     try:
-        tf = tarfile.open(package, mode="r:gz")
-        tf.extractall(tmp_deploy_dir)
+        digest, package_dir = packages.extract_package(package)
+        log.debug('Package {0} is {1}'.format(package, digest))
         # look for manifest
-        manifest = os.path.join(tmp_deploy_dir, 'manifest.json')
+        manifest = os.path.join(package_dir, 'manifest.json')
         if os.path.exists(manifest):
             mdata = json.loads(open(manifest, 'r').read())
             if not app_name:
@@ -52,15 +55,8 @@ def deploy_app(app_name=None, package=None, build_ve=True, force_rebuild_ve=Fals
             else:
                 ## attempt to stop before deploy
                 #stop_application(app_name)
-                # get app config
-                app_config = utils.get_application_config(app_name)
-                if app_config:
-                    try:
-                        app_config = json.loads(app_config)
-                    except:
-                        app_config = {}
-                else:
-                    app_config = {}
+                # get app config (only the fields the deploy changes)
+                app_config = utils.get_application_config(app_name, ['uuid', 'instances']) or {}
                 # create a uuid if non existent
                 if 'uuid' not in app_config:
                     app_uuid = str(uuid.uuid4())
@@ -72,13 +68,14 @@ def deploy_app(app_name=None, package=None, build_ve=True, force_rebuild_ve=Fals
                 else:
                     version = None
                 app_config['version'] = version
+                app_config['package'] = digest
                 if 'packages' in mdata:
                     pkgs = mdata['packages']
                 else:
                     pkgs = None
                 app_config['packages'] = pkgs
-                if os.path.exists(os.path.join(tmp_deploy_dir, 'requirements.txt')):
-                    reqs = os.path.join(tmp_deploy_dir, 'requirements.txt')
+                if os.path.exists(os.path.join(package_dir, 'requirements.txt')):
+                    reqs = os.path.join(package_dir, 'requirements.txt')
                 else:
                     reqs = None
                 if 'runtime' in mdata:
@@ -111,88 +108,105 @@ def deploy_app(app_name=None, package=None, build_ve=True, force_rebuild_ve=Fals
                 #    port = utils.get_next_application_port()
                 #    app_config['port'] = port
                 # get instances
-                if 'instances' in app_config:
-                    instances = app_config['instances']
-                    if settings.NODE_NAME in instances:
-                        instances = instances[settings.NODE_NAME]
-                    else:
-                        instances = []
-                else:
-                    instances = []
+                instances = app_config.pop('instances', {}).get(settings.NODE_NAME, [])
                 if not instances:
-                    new_port = utils.get_next_application_port()
+                    new_port = utils.reserve_application_ports(1)[0]
                     instances.append(new_port)
-                    utils.reserve_application_port(new_port)
                     log.debug('Reserved port {0} for {1}'.format(new_port, app_name))
-                    app_config['instances'] = {}
-                    app_config['instances'][settings.NODE_NAME] = instances
-                # install app
-                app_dir = os.path.join(settings.APPLICATION_BASE_DIR, app_name)
-                if not os.path.exists(app_dir):
-                    os.makedirs(app_dir)
-                else:
-                    # remove existing and re-create 
-                    shutil.rmtree(app_dir)
-                    os.makedirs(app_dir)
-                install_app_data = {}
+                    app_config['instances'] = {settings.NODE_NAME: instances}
+                # install app into a new release (the live one is untouched
+                # until the switch)
+                # the dependencies are kept to rebuild the virtualenv on a rollback
+                requirements = open(reqs, 'r').read() if reqs else None
+                release = releases.create_release(app_name, version=version, package=digest, \
+                    packages=pkgs, requirements=requirements, runtime=runtime)
+                release_dir = releases.get_release_dir(app_name, release)
+                log.info('{0}: installing release {1}'.format(app_name, release))
+                install_app_data = {'release': release}
                 if repo_type and repo_url:
                     log.info('Cloning {0} from {1} using {2}'.format(app_name, repo_url, repo_type))
                     install_app_data['repo_url'] = repo_url
                     if repo_type == 'git':
                         install_app_data['repo_init'] = 'Cloning with git'
-                        p = Popen(['git', 'clone', repo_url], stdout=PIPE, stderr=PIPE, cwd=app_dir)
-                        os.waitpid(p.pid, 0)
+                        p = Popen(['git', 'clone', repo_url], stdout=PIPE, stderr=PIPE, cwd=release_dir)
                     elif repo_type == 'hg':
                         install_app_data['repo_init'] = 'Cloning with mercurial'
-                        p = Popen(['hg', 'clone', repo_url], stdout=PIPE, stderr=PIPE,  cwd=app_dir)
-                        os.waitpid(p.pid, 0)
+                        p = Popen(['hg', 'clone', repo_url], stdout=PIPE, stderr=PIPE,  cwd=release_dir)
                     else:
                         log.error('Unknown repo type: {0}'.format(repo_type))
                         p = None
                     if p:
-                        p_out, p_err = p.stdout, p.stderr
-                        install_app_data['repo_out'] = p_out.read()
-                        install_app_data['repo_err'] = p_out.read()
+                        install_app_data['repo_out'], install_app_data['repo_err'] = \
+                            p.communicate()
+                        if p.returncode != 0:
+                            raise Retry('{0} clone exited with {1}: {2}'.format(repo_type, \
+                                p.returncode, install_app_data['repo_err']))
                     # checkout revision if needed
                     if repo_revision:
                         log.info('{0}: checking out revision {1}'.format(app_name, repo_revision))
+                        repo_dir = os.path.join(release_dir, \
+                            releases.get_release_code_dir(app_name, release))
                         if repo_type == 'git':
-                            p = Popen(['git', 'checkout', repo_revision], stdout=PIPE, stderr=PIPE, cwd=app_dir)
+                            p = Popen(['git', 'checkout', repo_revision], stdout=PIPE, stderr=PIPE, cwd=repo_dir)
                         elif repo_type == 'hg':
-                            p = Popen(['hg', 'checkout', repo_revision], stdout=PIPE, stderr=PIPE, cwd=app_dir)
+                            p = Popen(['hg', 'checkout', repo_revision], stdout=PIPE, stderr=PIPE, cwd=repo_dir)
                         else:
                             log.error('{0}: Unknown repo type: {0}'.format(app_name, repo_type))
                             p = None
                         if p:
-                            os.waitpid(p.pid, 0)
+                            p_out, p_err = p.communicate()
+                            if p.returncode != 0:
+                                # an unknown revision will not appear by retrying
+                                raise RuntimeError('{0} checkout of {1} exited with {2}: {3}'.format( \
+                                    repo_type, repo_revision, p.returncode, p_err))
                 else:
                     log.debug('{0}: installing application'.format(app_name))
-                    app_dir_target = os.path.join(app_dir, app_name)
-                    shutil.copytree(tmp_deploy_dir, app_dir_target)
+                    app_dir_target = os.path.join(release_dir, app_name)
+                    # link the cached package instead of copying it
+                    os.symlink(package_dir, app_dir_target)
                 output['install_app'] = install_app_data
                 # install ve
                 if build_ve:
                     output['install_virtualenv'] = install_virtualenv(application=app_name, packages=pkgs, \
                         requirements=reqs, runtime=runtime, force=force_rebuild_ve)
+                    ve_errors = output['install_virtualenv']['errors']
+                    if 'install' in ve_errors:
+                        raise Retry(ve_errors['install'])
+                    elif ve_errors:
+                        raise RuntimeError(ve_errors)
+                    # remembered for rollbacks
+                    info = releases.get_release_info(app_name, release)
+                    info['fingerprint'] = output['install_virtualenv']['output']['fingerprint']
+                    releases.set_release_info(app_name, release, info)
                 # update app config
+                app_config['release'] = release
                 utils.update_application_config(app_name, app_config)
-                # configure supervisor
-                output['configure_supervisor'] = configure_supervisor(application=app_name)
-                output['configure_webserver'] = configure_webserver(application=app_name)
+                # switch to the new release (supervisor runs from it) and
                 # restart app
+                releases.activate_release(app_name, release)
+                output['configure_supervisor'] = configure_supervisor(application=app_name, \
+                    release=release)
+                output['configure_webserver'] = configure_webserver(application=app_name)
                 restart_application(app_name)
+                output['removed_releases'] = releases.prune_releases(app_name)
         else:
             log.error('Missing package manifest')
             errors['deploy'] = 'missing package manifest'
+    except Retry, e:
+        log.warn('Deploy failed, will be retried: {0}'.format(e))
+        # drop a release that never went live
+        if release and release != releases.get_current_release(app_name):
+            releases.remove_release(app_name, release)
+        raise
     except Exception, e:
         traceback.print_exc()
         log.error('Deploy: {0}'.format(traceback.format_exc()))
         errors['deploy'] = str(e)
+        # drop a release that never went live
+        if release and release != releases.get_current_release(app_name):
+            releases.remove_release(app_name, release)
     # add app to node app list
     utils.add_app_to_node_app_list(app_name)
-    # cleanup
-    if os.path.exists(tmp_deploy_dir):
-        shutil.rmtree(tmp_deploy_dir)
     log.info('Deployment for {0} complete'.format(app_name))
     data = {
         "status": "complete",
@@ -202,6 +216,7 @@ def deploy_app(app_name=None, package=None, build_ve=True, force_rebuild_ve=Fals
     }
     return data
 
+@step()
 def install_virtualenv(application=None, packages=None, requirements=None, \
     runtime=None, force=False):
     """
@@ -213,56 +228,61 @@ def install_virtualenv(application=None, packages=None, requirements=None, \
     :keyword packages: List of packages to install
     :keyword requirements: (optional) Path to requirements.txt file
     :keyword runtime: (optional) Python runtime to use
-    :keyword force: (optional) Forces build of virtualenv (destroys existing)
+    :keyword force: (optional) Forces build of virtualenv (replaces existing)
+
+    The virtualenv is built once per runtime and dependency set in
+    ``VIRTUALENV_CACHE_DIR`` and ``VIRTUALENV_BASE_DIR/<application>`` links
+    to it.
 
     """
     log = config.get_logger('install_virtualenv')
     log.info('{0}: Installing virtualenv'.format(application))
     errors = {}
     output = {}
-    # get ve target dir
-    ve_target_dir = os.path.join(settings.VIRTUALENV_BASE_DIR, application)
-    if force and os.path.exists(ve_target_dir):
-        log.warn('{0}: Removing existing virtualenv'.format(application))
-        shutil.rmtree(ve_target_dir)
-    # create if needed
-    if not os.path.exists(ve_target_dir):
-        log.debug('{0}: Creating virtualenv in {1}'.format(application, ve_target_dir))
-        if runtime:
-            log.debug('{0}: Runtime {1} specified'.format(application, runtime))
-            p = Popen(['which {0}'.format(runtime)], stdout=PIPE, stderr=PIPE, shell=True)
-            p_out, p_err = p.stdout, p.stderr
-            runtime_path = p_out.read()
-            log.debug('{0}: Using runtime {1}'.format(application, runtime_path))
-            p = Popen(['virtualenv', '--no-site-packages', '-p', runtime, ve_target_dir], stdout=PIPE, stderr=PIPE)
-            os.waitpid(p.pid, 0)
+    # environments are shared by every application with the same runtime
+    # and dependencies
+    fingerprint = virtualenvs.get_virtualenv_fingerprint(packages, requirements, runtime)
+    output['fingerprint'] = fingerprint
+    with virtualenvs.virtualenv_lock(fingerprint):
+        if not force and virtualenvs.is_virtualenv_complete(fingerprint):
+            log.info('{0}: Using existing virtualenv {1}'.format(application, fingerprint))
+            output['virtualenv'] = 'reused'
         else:
-            p = Popen(['virtualenv', '--no-site-packages', ve_target_dir], stdout=PIPE, stderr=PIPE)
-            os.waitpid(p.pid, 0)
-        (p_out, p_err) = (p.stdout, p.stderr)
-        out = p_out.read()
-        err = p_err.read()
-        output['virtualenv_create_out'] = out
-        output['virtualenv_create_err'] = err
-    # install packages
-    for pkg in packages:
-        log.debug('{0}: Installing {1} in {2}'.format(application, pkg, ve_target_dir))
-        p = Popen([os.path.join(os.path.join(ve_target_dir, 'bin'), 'pip'), 'install', '--use-mirrors', pkg], stdout=PIPE, stderr=PIPE)
-        os.waitpid(p.pid, 0)
-        (p_out, p_err) = (p.stdout, p.stderr)
-        out = p_out.read()
-        err = p_err.read()
-        output['virtualenv_{0}_out'.format(pkg)] = out
-        output['virtualenv_{0}_err'.format(pkg)] = err
-    if requirements and os.path.exists(requirements):
-        log.debug('{0}: Installing packages via {1} requirements file in {2}'.format(application, requirements, ve_target_dir))
-        p = Popen([os.path.join(os.path.join(ve_target_dir, 'bin'), 'pip'), 'install', '--use-mirrors', '-r', requirements], stdout=PIPE, stderr=PIPE)
-        os.waitpid(p.pid, 0)
-        (p_out, p_err) = (p.stdout, p.stderr)
-        out = p_out.read()
-        err = p_err.read()
-        output['virtualenv_requirements_out'.format(pkg)] = out
-        output['virtualenv_requirements_err'.format(pkg)] = err
+            # build next to the one in use (forced or a previous build did
+            # not finish) and swap it in once complete
+            ve_target_dir = virtualenvs.get_virtualenv_build_dir(fingerprint)
+            log.debug('{0}: Creating virtualenv in {1}'.format(application, ve_target_dir))
+            if runtime:
+                log.debug('{0}: Runtime {1} specified'.format(application, runtime))
+                p = Popen(['which {0}'.format(runtime)], stdout=PIPE, stderr=PIPE, shell=True)
+                p_out, p_err = p.stdout, p.stderr
+                runtime_path = p_out.read()
+                log.debug('{0}: Using runtime {1}'.format(application, runtime_path))
+                p = Popen(['virtualenv', '--no-site-packages', '-p', runtime, ve_target_dir], stdout=PIPE, stderr=PIPE)
+            else:
+                p = Popen(['virtualenv', '--no-site-packages', ve_target_dir], stdout=PIPE, stderr=PIPE)
+            out, err = p.communicate()
+            output['virtualenv_create_out'] = out
+            output['virtualenv_create_err'] = err
+            if p.returncode != 0:
+                errors['virtualenv'] = 'virtualenv exited with {0}'.format(p.returncode)
+            # install every dependency in one resolver pass
+            deps = _get_pip_requirements(packages, requirements)
+            if deps and not errors:
+                log.debug('{0}: Installing {1} in {2}'.format(application, ' '.join(deps), \
+                    ve_target_dir))
+                rc = _install_requirements(ve_target_dir, deps, output)
+                if rc != 0:
+                    errors['install'] = 'pip exited with {0}'.format(rc)
+            if errors:
+                log.error('{0}: Virtualenv build failed: {1}'.format(application, errors))
+                shutil.rmtree(ve_target_dir, ignore_errors=True)
+            else:
+                virtualenvs.activate_virtualenv_build(fingerprint, ve_target_dir)
+        # a failed build keeps the application on its previous virtualenv
+        if not errors:
+            virtualenvs.link_virtualenv(application, fingerprint)
+    virtualenvs.prune_virtualenvs()
     data = {
         "status": "complete",
         "output": output,
@@ -272,6 +292,47 @@ def install_virtualenv(application=None, packages=None, requirements=None, \
     log.info('{0}: Virtualenv creation complete'.format(application))
     return data
 
+def _get_pip_requirements(packages=None, requirements=None):
+    deps = list(packages or [])
+    if requirements and os.path.exists(requirements):
+        deps.extend(['-r', requirements])
+    return deps
+
+def _run_pip(ve_dir=None, args=[]):
+    p = Popen([os.path.join(ve_dir, 'bin', 'pip')] + args, stdout=PIPE, stderr=PIPE)
+    out, err = p.communicate()
+    return p.returncode, out, err
+
+def _install_requirements(ve_dir=None, deps=[], output={}):
+    """
+    Installs ``deps`` (pip requirement arguments) into a virtualenv from
+    the node wheelhouse
+
+    Missing wheels are built into ``WHEELHOUSE_DIR`` first (skipped with
+    ``PIP_OFFLINE``) so later installs need no index.  Returns the pip
+    exit code.
+
+    """
+    log = config.get_logger('install_virtualenv')
+    find_links = ['--find-links', settings.WHEELHOUSE_DIR]
+    if not settings.PIP_OFFLINE:
+        with virtualenvs.wheelhouse_lock():
+            rc, out, err = _run_pip(ve_dir, ['wheel', '--wheel-dir', \
+                settings.WHEELHOUSE_DIR] + find_links + deps)
+        output['wheelhouse_out'] = out
+        output['wheelhouse_err'] = err
+        if rc != 0:
+            # no wheel support (old pip) -- install from the index
+            log.warn('Unable to build wheels ({0}); installing from index'.format(rc))
+            rc, out, err = _run_pip(ve_dir, ['install'] + find_links + deps)
+            output['virtualenv_install_out'] = out
+            output['virtualenv_install_err'] = err
+            return rc
+    rc, out, err = _run_pip(ve_dir, ['install', '--no-index'] + find_links + deps)
+    output['virtualenv_install_out'] = out
+    output['virtualenv_install_err'] = err
+    return rc
+
 def configure_appserver(application=None):
     """
     Configures application server (current uWSGI)
@@ -291,6 +352,7 @@ def configure_appserver(application=None):
     }
     return data
 
+@step()
 def configure_webserver(application=None):
     """
     Configures webserver (current Nginx)
@@ -302,13 +364,11 @@ def configure_webserver(application=None):
     log.info('{0}: configuring webserver'.format(application))
     errors = {}
     output = {}
-    app_config = utils.get_application_config(application)
-    try:
-        app_config = json.loads(app_config)
-    except:
+    instances = utils.get_application_instances(application)
+    if instances is None:
         raise RuntimeError('Invalid or missing application config')
     app_state_dir = os.path.join(settings.APPLICATION_STATE_DIR, application)
-    for instance in app_config['instances'][settings.NODE_NAME]:
+    for instance in instances:
         # generate nginx config
         nginx_conf = os.path.join(settings.WEBSERVER_CONF_DIR, 'nginx_{0}_{1}.conf'.format(application, instance))
         conf = '# {0} config for application: {1} instance {2}\n'.format(settings.APP_NAME, application, instance)
@@ -348,28 +408,38 @@ def configure_webserver(application=None):
     }
     return data
 
-def configure_supervisor(application=None, uwsgi_args={}):
+@step()
+def configure_supervisor(application=None, uwsgi_args={}, release=None):
     """
     Configures supervisord
 
+    uWSGI runs from the ``current`` release link so a restart picks up
+    whichever release is active.
+
     :keyword application: Application to configure
+    :keyword release: Release to take the code layout from (default current)
 
     """
     log = config.get_logger('configure_supervisor')
     log.info('{0}: configuring supervisor'.format(application))
     errors = {}
     output = {}
-    app_config = utils.get_application_config(application)
-    try:
-        app_config = json.loads(app_config)
-    except:
+    instances = utils.get_application_instances(application)
+    if instances is None:
         raise RuntimeError('Invalid or missing application config')
     app_dir = os.path.join(settings.APPLICATION_BASE_DIR, application)
     app_state_dir = os.path.join(settings.APPLICATION_STATE_DIR, application)
-    app_local_dir = os.listdir(app_dir)[0]
+    release = release or releases.get_current_release(application)
+    if release:
+        app_local_dir = releases.get_release_code_dir(application, release)
+        app_run_dir = releases.get_current_dir(application)
+    else:
+        # installed before releases
+        app_local_dir = os.listdir(app_dir)[0]
+        app_run_dir = app_dir
     if not os.path.exists(app_state_dir):
         os.makedirs(app_state_dir)
-    for instance in app_config['instances'][settings.NODE_NAME]:
+    for instance in instances:
         # generate uwsgi config
         supervisor_conf = os.path.join(settings.SUPERVISOR_CONF_DIR, 'uwsgi_{0}_{1}.conf'.format(application, instance))
         uwsgi_config = '[program:uwsgi_{0}_{1}]\n'.format(application, instance)
@@ -391,8 +461,7 @@ def configure_supervisor(application=None, uwsgi_args={}):
         # uwsgi args
         for k,v in uwsgi_args.iteritems():
             uwsgi_config += '  --{0} {1}\n'.format(k, v)
-        uwsgi_config += 'directory={0}\n'.format(os.path.join(settings.APPLICATION_BASE_DIR, \
-            application))
+        uwsgi_config += 'directory={0}\n'.format(app_run_dir)
         uwsgi_config += 'user={0}\n'.format(settings.APPLICATION_USER)
         uwsgi_config += 'redirect_stderr=true\n'
         uwsgi_config += 'stdout_logfile={0}/{1}.log\n'.format(settings.SUPERVISOR_CONF_DIR, application)
@@ -414,7 +483,7 @@ def configure_supervisor(application=None, uwsgi_args={}):
     }
     return data
 
-@task
+@task(priority='high', coalesce=True)
 def stop_application(app_name=None):
     """
     Stops an application
@@ -428,12 +497,10 @@ def stop_application(app_name=None):
     log.info('{0}: stopping application'.format(app_name))
     errors = {}
     output = {}
-    app_config = utils.get_application_config(app_name)
-    try:
-        app_config = json.loads(app_config)
-    except:
+    instances = utils.get_application_instances(app_name)
+    if instances is None:
         raise RuntimeError('Invalid or missing application config')
-    for instance in app_config['instances'][settings.NODE_NAME]:
+    for instance in instances:
         # signal nginx to stop
         app_nginx_conf = os.path.join(settings.WEBSERVER_CONF_DIR, 'nginx_{0}_{1}.conf'.format(app_name, instance))
         if os.path.exists(app_nginx_conf):
@@ -465,7 +532,8 @@ def stop_application(app_name=None):
     }
     return data
 
-@task
+@task(priority='high', coalesce=True)
+@step()
 def restart_application(app_name=None):
     """
     Restarts an application
@@ -479,10 +547,8 @@ def restart_application(app_name=None):
     errors = {}
     output = {}
     log.info('{0}: restarting application'.format(app_name))
-    app_config = utils.get_application_config(app_name)
-    try:
-        app_config = json.loads(app_config)
-    except:
+    instances = utils.get_application_instances(app_name)
+    if instances is None:
         raise RuntimeError('Invalid or missing application config')
     # HACK: chown the state dir (and existing files)
     for f in glob.iglob('{0}'.format(settings.APPLICATION_STATE_DIR)):
@@ -497,7 +563,7 @@ def restart_application(app_name=None):
     # attempt to stop application first
     stop_application(app_name)
     # signal nginx to start
-    for instance in app_config['instances'][settings.NODE_NAME]:
+    for instance in instances:
         app_nginx_conf = os.path.join(settings.WEBSERVER_CONF_DIR, 'nginx_{0}_{1}.conf'.format(app_name, instance))
         if os.path.exists(app_nginx_conf):
             p = Popen(['nginx', '-c', app_nginx_conf], stdout=PIPE, stderr=PIPE)
@@ -521,7 +587,7 @@ def restart_application(app_name=None):
     }
     return data
 
-@task
+@task(coalesce=True)
 def remove_application(app_name=None):
     """
     Removes and application
@@ -536,9 +602,8 @@ def remove_application(app_name=None):
     output = {}
     if app_name not in utils.get_node_applications():
         raise NameError('Application not deployed to this node')
-    app_config = utils.get_application_config(app_name)
+    instances = utils.get_application_instances(app_name)
     try:
-        app_config = json.loads(app_config)
         # attempt to stop application first
         stop_application(app_name)
     except:
@@ -546,15 +611,13 @@ def remove_application(app_name=None):
     # remove configs
     app_state_dir = os.path.join(settings.APPLICATION_STATE_DIR, app_name)
     app_dir = os.path.join(settings.APPLICATION_BASE_DIR, app_name)
-    ve_dir = os.path.join(settings.VIRTUALENV_BASE_DIR, app_name)
     if os.path.exists(app_state_dir):
         shutil.rmtree(app_state_dir)
         output['app_state_dir'] = 'removed'
     if os.path.exists(app_dir):
         shutil.rmtree(app_dir)
         output['app_dir'] = 'removed'
-    if os.path.exists(ve_dir):
-        shutil.rmtree(ve_dir)
+    if virtualenvs.unlink_virtualenv(app_name):
         output['ve_dir'] = 'removed'
     # clear nginx configs
     for conf in os.listdir(settings.WEBSERVER_CONF_DIR):
@@ -570,9 +633,9 @@ def remove_application(app_name=None):
     for log_file in os.listdir(settings.APPLICATION_LOG_DIR):
         if re.search('{0}*'.format(app_name), log_file):
             os.remove(os.path.join(settings.APPLICATION_LOG_DIR, log_file))
-    # get app config to remove reserved instances
-    if app_config:
-        for instance in app_config['instances'][settings.NODE_NAME]:
+    # release reserved instances
+    if instances:
+        for instance in instances:
             log.debug('{0}: releasing port: {1}'.format(app_name, instance))
             utils.release_application_port(instance)
     output['reserved_ports'] = 'released'
@@ -594,7 +657,73 @@ def remove_application(app_name=None):
     }
     return data
 
-@task
+def _rebuild_release_virtualenv(app_name=None, info={}):
+    if 'packages' not in info and 'requirements' not in info:
+        raise RuntimeError('Virtualenv {0} is no longer cached and release {1} has no ' \
+            'dependency list to rebuild it'.format(info.get('fingerprint'), info.get('release')))
+    requirements = None
+    if info.get('requirements'):
+        requirements = tempfile.mktemp()
+        with open(requirements, 'w') as f:
+            f.write(info['requirements'])
+    try:
+        rv = install_virtualenv(application=app_name, packages=info.get('packages'), \
+            requirements=requirements, runtime=info.get('runtime'))
+    finally:
+        if requirements:
+            os.remove(requirements)
+    if rv['errors']:
+        raise RuntimeError('Unable to rebuild virtualenv {0}: {1}'.format( \
+            info.get('fingerprint'), rv['errors']))
+    return rv
+
+@task(supersede=True)
+def rollback_application(app_name=None, release=None):
+    """
+    Switches an application back to an earlier release
+
+    :keyword app_name: Name of application to roll back
+    :keyword release: Release to switch to (default the previous release)
+
+    """
+    if not app_name:
+        raise NameError('You must specify an application name')
+    log = config.get_logger('rollback_application')
+    errors = {}
+    output = {}
+    release = release or releases.get_previous_release(app_name)
+    if not release:
+        raise NameError('No release to roll back to')
+    log.info('{0}: rolling back to release {1}'.format(app_name, release))
+    info = releases.get_release_info(app_name, release)
+    # relink (or rebuild) the virtualenv the release was deployed with --
+    # before switching so the old code never runs with new dependencies
+    fingerprint = info.get('fingerprint')
+    if fingerprint:
+        with virtualenvs.virtualenv_lock(fingerprint):
+            cached = virtualenvs.is_virtualenv_complete(fingerprint)
+            if cached:
+                virtualenvs.link_virtualenv(app_name, fingerprint)
+        if not cached:
+            log.warn('{0}: virtualenv {1} is no longer cached; rebuilding'.format(app_name, \
+                fingerprint))
+            output['install_virtualenv'] = _rebuild_release_virtualenv(app_name, info)
+    utils.update_application_config(app_name, {'release': release, \
+        'version': info.get('version'), 'package': info.get('package')})
+    releases.activate_release(app_name, release)
+    output['configure_supervisor'] = configure_supervisor(application=app_name, \
+        release=release)
+    restart_application(app_name)
+    output['release'] = release
+    data = {
+        "status": "complete",
+        "output": output,
+        "errors": errors,
+        "operation": "rollback_application",
+    }
+    return data
+
+@task(supersede=True)
 def scale_application(app_name=None, instances=None):
     """
     Scales application to number of instances
@@ -611,10 +740,8 @@ def scale_application(app_name=None, instances=None):
     # attempt to stop application first
     stop_application(app_name)
     log.info('{0}: scaling application'.format(app_name))
-    app_config = utils.get_application_config(app_name)
-    try:
-        app_config = json.loads(app_config)
-    except:
+    app_instances = utils.get_application_instances(app_name)
+    if app_instances is None:
         raise RuntimeError('Invalid or missing application config')
 
 
@@ -1,19 +1,211 @@
 #!/usr/bin/env python
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
 import application
 import schema
-import logging
+import settings
 try:
     import simplejson as json
 except ImportError:
     import json
 
 class RedisHandler(logging.Handler):
-    def __init__(self):
+    """
+    Buffered log handler that writes to Redis from a background thread
+
+    Records are queued in memory (at most ``capacity``) and written in
+    pipelined batches once ``batch_size`` records are waiting or every
+    ``flush_interval`` seconds.  When the buffer is full the oldest (or,
+    with ``drop_policy='newest'``, the incoming) DEBUG/INFO record is
+    dropped.  WARN and above are never dropped -- with no DEBUG/INFO record
+    left to make room they are written right away.
+
+    """
+    def __init__(self, capacity=None, batch_size=None, flush_interval=None, \
+        drop_policy=None):
         logging.Handler.__init__(self)
+        self.capacity = capacity or settings.LOG_BUFFER_SIZE
+        self.batch_size = batch_size or settings.LOG_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.LOG_FLUSH_INTERVAL
+        self.drop_policy = drop_policy or settings.LOG_DROP_POLICY
+        self._reset()
+        atexit.register(self.close)
 
-    def emit(self, msg):
+    def _reset(self):
+        self._pid = os.getpid()
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._writer = None
+        self._closed = False
+        self._stats = {
+            'queued': 0,
+            'written': 0,
+            'dropped': 0,
+            'errors': 0,
+        }
+
+    def _ensure_writer(self):
+        # the writer thread (and the parent's buffer) do not belong to a
+        # forked child
+        if self._pid != os.getpid():
+            self._reset()
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run)
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _run(self):
+        while not self._closed:
+            with self._cond:
+                if len(self._buffer) < self.batch_size and not self._closed:
+                    self._cond.wait(self.flush_interval)
+            self.flush()
+
+    def _take_batch(self):
+        with self._cond:
+            batch = []
+            while self._buffer and len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+        return batch
+
+    def _write(self, batch=[]):
         db = application.get_db_connection()
+        pipe = db.pipeline(transaction=False)
+        for data in batch:
+            # repr keeps the full precision of the timestamp
+            pipe.zadd(schema.LOGS_KEY, json.dumps(data), repr(data['date']))
+        # cap by length and age
+        if settings.LOG_MAX_LENGTH:
+            pipe.zremrangebyrank(schema.LOGS_KEY, 0, -(settings.LOG_MAX_LENGTH + 1))
+        if settings.LOG_MAX_AGE:
+            pipe.zremrangebyscore(schema.LOGS_KEY, '-inf', \
+                '({0!r}'.format(time.time() - settings.LOG_MAX_AGE))
+        pipe.execute()
+
+    def _get_droppable(self):
+        # index of the oldest DEBUG/INFO record (or None)
+        for i, data in enumerate(self._buffer):
+            if data['level'] < logging.WARN:
+                return i
+        return None
+
+    def emit(self, msg):
         data = schema.log(msg.levelno, msg.name, msg.msg)
-        log_key = schema.LOG_KEY.format('{0}:{1}'.format(data['category'], data['date']))
-        db.set(log_key, json.dumps(data))
+        important = msg.levelno >= logging.WARN
+        self._ensure_writer()
+        with self._cond:
+            if len(self._buffer) >= self.capacity:
+                i = self._get_droppable()
+                if not important and (i is None or self.drop_policy == 'newest'):
+                    self._stats['dropped'] += 1
+                    return
+                if i is not None:
+                    self._stats['dropped'] += 1
+                    del self._buffer[i]
+            if len(self._buffer) < self.capacity:
+                self._buffer.append(data)
+                self._stats['queued'] += 1
+                if len(self._buffer) >= self.batch_size:
+                    self._cond.notify()
+                return
+        # full of WARN and above -- write this one synchronously
+        try:
+            self._write([data])
+            self._stats['written'] += 1
+        except Exception:
+            self._stats['errors'] += 1
+            self._stats['dropped'] += 1
+
+    def flush(self):
+        """
+        Writes all buffered records
+
+        """
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                break
+            try:
+                self._write(batch)
+                self._stats['written'] += len(batch)
+            except Exception:
+                # never let logging break the caller -- count and drop
+                self._stats['errors'] += 1
+                self._stats['dropped'] += len(batch)
+
+    def close(self):
+        if self._pid == os.getpid():
+            # stop the writer before the interpreter tears down
+            with self._cond:
+                self._closed = True
+                self._cond.notify()
+            if self._writer is not None:
+                self._writer.join(self.flush_interval)
+            self.flush()
+        logging.Handler.close(self)
+
+    def get_stats(self):
+        with self._cond:
+            stats = {'buffered': len(self._buffer)}
+            stats.update(self._stats)
+        return stats
+
+class RateLimitFilter(logging.Filter):
+    """
+    Per category (logger name) sampling and rate limiting
+
+    DEBUG records are sampled (1 in ``sample`` kept) and DEBUG/INFO records
+    are rate limited with a token bucket (``rate`` per second, ``burst``
+    bucket size).  WARN and above always pass.
+
+    :keyword limits: Dict of category to limits (``default`` applies to
+        categories not listed)
+
+    """
+    def __init__(self, limits=None):
+        logging.Filter.__init__(self)
+        self.limits = limits if limits is not None else settings.LOG_LIMITS
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._buckets = {}
+        self._suppressed = {}
+
+    def _get_limits(self, category=None):
+        return self.limits.get(category, self.limits.get('default', {}))
+
+    def _suppress(self, category=None, reason=None):
+        counts = self._suppressed.setdefault(category, {'sampled': 0, 'rate_limited': 0})
+        counts[reason] += 1
+        return False
+
+    def filter(self, record):
+        if record.levelno >= logging.WARN:
+            return True
+        category = record.name
+        limits = self._get_limits(category)
+        with self._lock:
+            sample = limits.get('sample', 1)
+            if record.levelno <= logging.DEBUG and sample > 1:
+                count = self._counts.get(category, 0)
+                self._counts[category] = count + 1
+                if count % sample:
+                    return self._suppress(category, 'sampled')
+            rate = limits.get('rate')
+            if rate:
+                burst = limits.get('burst', rate)
+                now = time.time()
+                tokens, last = self._buckets.get(category, (burst, now))
+                tokens = min(burst, tokens + (now - last) * rate)
+                if tokens < 1:
+                    self._buckets[category] = (tokens, now)
+                    return self._suppress(category, 'rate_limited')
+                self._buckets[category] = (tokens - 1, now)
+        return True
 
+    def get_stats(self):
+        with self._lock:
+            return dict((k, dict(v)) for k, v in self._suppressed.iteritems())
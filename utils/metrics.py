@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+import application
+import schema
+import settings
+import utils
+
+def _get_bucket(value=None):
+    for le in settings.METRICS_BUCKETS:
+        if value <= le:
+            return repr(float(le))
+    return '+Inf'
+
+def record_task(name=None, status=None, wait=None, duration=None):
+    """
+    Records a finished task run
+
+    Counters and histograms (non-cumulative buckets) are kept per task name
+    in one hash so all worker processes add to the same numbers.
+
+    :keyword name: Task name
+    :keyword status: Final status (complete, error, retrying)
+    :keyword wait: Seconds the task waited in the queue
+    :keyword duration: Seconds the task ran
+
+    """
+    db = application.get_db_connection()
+    pipe = db.pipeline(transaction=False)
+    pipe.hincrby(schema.TASK_METRICS_KEY, 'finished:{0}:{1}'.format(name, status), 1)
+    for metric, value in (('wait', wait), ('duration', duration)):
+        if value is None:
+            continue
+        value = max(0, value)
+        pipe.hincrby(schema.TASK_METRICS_KEY, '{0}:{1}:{2}'.format(metric, name, \
+            _get_bucket(value)), 1)
+        pipe.execute_command('HINCRBYFLOAT', schema.TASK_METRICS_KEY, \
+            '{0}_sum:{1}'.format(metric, name), repr(value))
+    pipe.execute()
+    return True
+
+def _format_labels(**labels):
+    return ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) \
+        for k, v in sorted(labels.items()))
+
+def _sample(name=None, value=None, **labels):
+    if labels:
+        return '{0}{{{1}}} {2}'.format(name, _format_labels(**labels), value)
+    return '{0} {1}'.format(name, value)
+
+def get_metrics():
+    """
+    Returns the queue and task metrics in the Prometheus text format
+
+    """
+    db = application.get_db_connection()
+    pipe = db.pipeline(transaction=False)
+    pipe.hgetall(schema.TASK_METRICS_KEY)
+    pipe.zcard(schema.TASK_SCHEDULE_KEY)
+    pipe.zcard(schema.PENDING_TASKS_INDEX_KEY)
+    pipe.scard(schema.WORKERS_KEY)
+    fields, scheduled, pending, workers = pipe.execute()
+    counters = {}
+    histograms = {}
+    sums = {}
+    for field, value in fields.iteritems():
+        metric, name = field.split(':', 1)
+        if metric in ('wait', 'duration'):
+            name, le = name.rsplit(':', 1)
+            histograms.setdefault((metric, name), {})[le] = int(value)
+        elif metric.endswith('_sum'):
+            sums[(metric[:-4], name)] = float(value)
+        elif metric == 'finished':
+            name, status = name.rsplit(':', 1)
+            counters.setdefault(metric, []).append(({'task': name, 'status': status}, value))
+        else:
+            counters.setdefault(metric, []).append(({'task': name}, value))
+    lines = []
+    lines.append('# HELP terminus_queue_depth Tasks waiting on a lane')
+    lines.append('# TYPE terminus_queue_depth gauge')
+    for lane, depth in utils.get_queue_depths():
+        lines.append(_sample('terminus_queue_depth', depth, lane=lane))
+    for metric, value, text in (('scheduled', scheduled, 'Delayed tasks not yet due'), \
+        ('pending', pending, 'Tasks queued but not started'), \
+        ('workers', workers, 'Registered queue workers')):
+        lines.append('# HELP terminus_queue_{0} {1}'.format(metric, text))
+        lines.append('# TYPE terminus_queue_{0} gauge'.format(metric))
+        lines.append(_sample('terminus_queue_{0}'.format(metric), value))
+    for metric, text in (('enqueued', 'Tasks queued'), \
+        ('coalesced', 'Calls merged into an identical pending task'), \
+        ('superseded', 'Pending tasks replaced by a newer call'), \
+        ('finished', 'Task runs by final status')):
+        lines.append('# HELP terminus_tasks_{0}_total {1}'.format(metric, text))
+        lines.append('# TYPE terminus_tasks_{0}_total counter'.format(metric))
+        for labels, value in sorted(counters.get(metric, [])):
+            lines.append(_sample('terminus_tasks_{0}_total'.format(metric), value, **labels))
+    buckets = [repr(float(x)) for x in settings.METRICS_BUCKETS] + ['+Inf']
+    for metric, text in (('wait', 'Time tasks waited in the queue'), \
+        ('duration', 'Time tasks ran')):
+        name = 'terminus_task_{0}_seconds'.format(metric)
+        lines.append('# HELP {0} {1}'.format(name, text))
+        lines.append('# TYPE {0} histogram'.format(name))
+        for (m, task), counts in sorted(histograms.items()):
+            if m != metric:
+                continue
+            total = 0
+            for le in buckets:
+                total += counts.get(le, 0)
+                lines.append(_sample(name + '_bucket', total, task=task, le=le))
+            lines.append(_sample(name + '_sum', repr(sums.get((metric, task), 0.0)), task=task))
+            lines.append(_sample(name + '_count', total, task=task))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+import errno
+import glob
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import settings
+
+# in-progress extractions (renamed into place once complete)
+TMP_PREFIX = '.tmp-'
+
+def get_package_digest(package=None):
+    """
+    Returns the SHA-256 (hex) of a package's contents
+
+    :keyword package: Path to the package
+
+    """
+    h = hashlib.sha256()
+    with open(package, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _get_size(path=None):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+def _get_used_packages():
+    # cache entries linked from an application release (or, for older
+    # installs, the application dir) are live or rollback code
+    used = set()
+    if not os.path.exists(settings.APPLICATION_BASE_DIR):
+        return used
+    for path in glob.glob(os.path.join(settings.APPLICATION_BASE_DIR, '*', '*')) + \
+        glob.glob(os.path.join(settings.APPLICATION_BASE_DIR, '*', 'releases', '*', '*')):
+        if os.path.islink(path):
+            used.add(os.path.basename(os.path.realpath(path)))
+    return used
+
+def extract_package(package=None):
+    """
+    Returns a (digest, path) tuple of the extracted package
+
+    Packages are extracted once into ``PACKAGE_CACHE_DIR/<sha256>``; later
+    calls with the same contents (redeploys, rollbacks) only mark the entry
+    as used.  Entries must be treated as read-only.
+
+    :keyword package: Path to the package (as tar.gz)
+
+    """
+    digest = get_package_digest(package)
+    cache_dir = settings.PACKAGE_CACHE_DIR
+    path = os.path.join(cache_dir, digest)
+    if os.path.exists(path):
+        # mtime is the LRU clock
+        os.utime(path, None)
+        return digest, path
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    tmp_dir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=cache_dir)
+    try:
+        tf = tarfile.open(package, mode='r:gz')
+        tf.extractall(tmp_dir)
+        tf.close()
+        os.chmod(tmp_dir, 0755)
+        try:
+            os.rename(tmp_dir, path)
+        except OSError:
+            # extracted concurrently by another worker
+            if not os.path.exists(path):
+                raise
+            shutil.rmtree(tmp_dir)
+    except:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        raise
+    prune_package_cache(keep=[digest])
+    return digest, path
+
+def get_cached_packages():
+    """
+    Returns the cached packages (most recently used first) as dicts
+
+    """
+    cache_dir = settings.PACKAGE_CACHE_DIR
+    if not os.path.exists(cache_dir):
+        return []
+    used = _get_used_packages()
+    packages = []
+    for digest in os.listdir(cache_dir):
+        if digest.startswith(TMP_PREFIX):
+            continue
+        path = os.path.join(cache_dir, digest)
+        packages.append({
+            'digest': digest,
+            'path': path,
+            'date': os.path.getmtime(path),
+            'size': _get_size(path),
+            'used': digest in used,
+        })
+    packages.sort(key=lambda x: x['date'], reverse=True)
+    return packages
+
+def prune_package_cache(max_size=None, max_entries=None, keep=[]):
+    """
+    Removes least recently used packages until the cache is within
+    ``max_size`` bytes and ``max_entries`` entries
+
+    Packages in use by an application (and ``keep``) are never removed.
+    Returns the removed digests.
+
+    :keyword max_size: Maximum size (default ``PACKAGE_CACHE_MAX_SIZE``)
+    :keyword max_entries: Maximum entries (default ``PACKAGE_CACHE_MAX_ENTRIES``)
+    :keyword keep: Digests to keep
+
+    """
+    if max_size is None:
+        max_size = settings.PACKAGE_CACHE_MAX_SIZE
+    if max_entries is None:
+        max_entries = settings.PACKAGE_CACHE_MAX_ENTRIES
+    packages = get_cached_packages()
+    size = sum(x['size'] for x in packages)
+    entries = len(packages)
+    removed = []
+    for pkg in reversed(packages):
+        if size <= max_size and entries <= max_entries:
+            break
+        if pkg['used'] or pkg['digest'] in keep:
+            continue
+        shutil.rmtree(pkg['path'], ignore_errors=True)
+        size -= pkg['size']
+        entries -= 1
+        removed.append(pkg['digest'])
+    # extractions abandoned by a killed worker
+    for name in os.listdir(settings.PACKAGE_CACHE_DIR):
+        path = os.path.join(settings.PACKAGE_CACHE_DIR, name)
+        if name.startswith(TMP_PREFIX) and time.time() - os.path.getmtime(path) > 3600:
+            shutil.rmtree(path, ignore_errors=True)
+    return removed
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+import os
+import time
+import threading
+import redis
+from redis.exceptions import ConnectionError
+import settings
+
+_pool = None
+_blocking_pool = None
+_pool_lock = threading.Lock()
+
+class PoolExhaustedError(ConnectionError):
+    """
+    Raised when all ``max_connections`` connections of a pool are in use
+
+    """
+    pass
+
+class ConnectionPool(redis.ConnectionPool):
+    """
+    Process-wide Redis connection pool
+
+    Connections are health checked (PING) when they have been idle longer
+    than ``health_check_interval`` and the pool resets itself when used from
+    a forked child so sockets are never shared between processes.
+
+    """
+    def __init__(self, health_check_interval=None, **kwargs):
+        redis.ConnectionPool.__init__(self, **kwargs)
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._created_connections = 0
+        self._available_connections = []
+        self._in_use_connections = set()
+        self._last_used = {}
+        self._stats = {
+            'checkouts': 0,
+            'health_checks': 0,
+            'health_check_failures': 0,
+        }
+
+    def _check_pid(self):
+        # a forked child must not reuse the parent sockets
+        if self.pid != os.getpid():
+            with self._lock:
+                if self.pid != os.getpid():
+                    self._reset()
+
+    def _check_health(self, connection):
+        if not self.health_check_interval:
+            return
+        last_used = self._last_used.get(connection)
+        if last_used is None or time.time() - last_used < self.health_check_interval:
+            return
+        self._stats['health_checks'] += 1
+        try:
+            connection.send_command('PING')
+            connection.read_response()
+        except ConnectionError:
+            self._stats['health_check_failures'] += 1
+            # reconnects on next command
+            connection.disconnect()
+
+    def make_connection(self):
+        "Create a new connection"
+        if self._created_connections >= self.max_connections:
+            raise PoolExhaustedError('Too many connections')
+        return redis.ConnectionPool.make_connection(self)
+
+    def get_connection(self, command_name, *keys, **options):
+        "Get a connection from the pool"
+        self._check_pid()
+        with self._lock:
+            try:
+                connection = self._available_connections.pop()
+            except IndexError:
+                connection = self.make_connection()
+            self._in_use_connections.add(connection)
+            self._stats['checkouts'] += 1
+        self._check_health(connection)
+        return connection
+
+    def release(self, connection):
+        "Releases the connection back to the pool"
+        self._check_pid()
+        with self._lock:
+            if connection not in self._in_use_connections:
+                # connection from before a fork
+                return
+            self._in_use_connections.remove(connection)
+            self._available_connections.append(connection)
+            self._last_used[connection] = time.time()
+
+    def get_stats(self):
+        self._check_pid()
+        with self._lock:
+            stats = {
+                'pid': self.pid,
+                'max_connections': self.max_connections,
+                'created_connections': self._created_connections,
+                'in_use_connections': len(self._in_use_connections),
+                'available_connections': len(self._available_connections),
+            }
+            stats.update(self._stats)
+        return stats
+
+class ReservedConnectionPool(object):
+    """
+    Holds one connection of ``pool`` for a client that blocks over and over
+    (an event stream) until ``close`` is called
+
+    """
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.connection = pool.get_connection('_reserve')
+
+    def get_connection(self, command_name, *keys, **options):
+        return self.connection
+
+    def release(self, connection):
+        pass
+
+    def close(self):
+        if self.connection is not None:
+            self.pool.release(self.connection)
+            self.connection = None
+
+def _create_pool(max_connections=None):
+    return ConnectionPool(host=settings.DB_HOST, port=settings.DB_PORT, \
+        db=settings.DB_NAME, password=settings.DB_PASSWORD, \
+        max_connections=max_connections, \
+        health_check_interval=settings.DB_HEALTH_CHECK_INTERVAL)
+
+def get_connection_pool():
+    """
+    Returns the connection pool for the current process
+
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _create_pool(settings.DB_MAX_CONNECTIONS)
+    return _pool
+
+def get_blocking_connection_pool():
+    """
+    Returns the connection pool for blocking reads (long polls) of the
+    current process
+
+    Blocking reads hold their connection for up to their timeout, so they
+    get their own (capped) pool and never starve other commands.
+
+    """
+    global _blocking_pool
+    if _blocking_pool is None:
+        with _pool_lock:
+            if _blocking_pool is None:
+                _blocking_pool = _create_pool(settings.DB_MAX_BLOCKING_CONNECTIONS)
+    return _blocking_pool
+
+def reserve_blocking_connection():
+    """
+    Returns a Redis client bound to one connection of the blocking pool
+    (raises ``PoolExhaustedError`` when none is left)
+
+    Call ``connection_pool.close()`` on the client once done.
+
+    """
+    return redis.Redis(connection_pool=ReservedConnectionPool(get_blocking_connection_pool()))
+
+def get_pool_stats():
+    """
+    Returns connection statistics for the current process pool
+
+    """
+    return get_connection_pool().get_stats()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+import settings
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# APPLICATION_BASE_DIR/<app>/releases/<release>/ holds each release and
+# APPLICATION_BASE_DIR/<app>/current links to the live one
+RELEASES_DIR = 'releases'
+CURRENT_LINK = 'current'
+RELEASE_INFO = 'release.json'
+
+def get_app_dir(app_name=None):
+    return os.path.join(settings.APPLICATION_BASE_DIR, app_name)
+
+def get_current_dir(app_name=None):
+    return os.path.join(get_app_dir(app_name), CURRENT_LINK)
+
+def get_release_dir(app_name=None, release=None):
+    return os.path.join(get_app_dir(app_name), RELEASES_DIR, release)
+
+def create_release(app_name=None, **info):
+    """
+    Creates an (inactive) release directory and returns its name
+
+    :keyword app_name: Application name
+    :keyword info: Release details (version, package, ...)
+
+    """
+    # names sort by creation time
+    release = '{0}-{1}'.format(datetime.utcnow().strftime('%Y%m%d%H%M%S%f'), \
+        uuid.uuid4().hex[:6])
+    release_dir = get_release_dir(app_name, release)
+    os.makedirs(release_dir)
+    info.update({'release': release, 'date': time.time()})
+    set_release_info(app_name, release, info)
+    return release
+
+def get_release_info(app_name=None, release=None):
+    try:
+        with open(os.path.join(get_release_dir(app_name, release), RELEASE_INFO), 'r') as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return {'release': release}
+
+def set_release_info(app_name=None, release=None, info={}):
+    with open(os.path.join(get_release_dir(app_name, release), RELEASE_INFO), 'w') as f:
+        f.write(json.dumps(info))
+
+def get_release_code_dir(app_name=None, release=None):
+    """
+    Returns the name of the code directory in a release (the package link
+    or the repository clone)
+
+    """
+    for name in sorted(os.listdir(get_release_dir(app_name, release))):
+        if name != RELEASE_INFO:
+            return name
+    return None
+
+def get_current_release(app_name=None):
+    current = get_current_dir(app_name)
+    if not os.path.islink(current):
+        return None
+    return os.path.basename(os.readlink(current))
+
+def get_releases(app_name=None):
+    """
+    Returns the releases of an application (newest first)
+
+    """
+    releases_dir = os.path.join(get_app_dir(app_name), RELEASES_DIR)
+    if not os.path.exists(releases_dir):
+        return []
+    current = get_current_release(app_name)
+    releases = []
+    for release in sorted(os.listdir(releases_dir), reverse=True):
+        info = get_release_info(app_name, release)
+        info['current'] = release == current
+        releases.append(info)
+    return releases
+
+def activate_release(app_name=None, release=None):
+    """
+    Switches the ``current`` link to a release
+
+    The new link is renamed over the old one so the application directory
+    is never missing.  Code installed directly in the application directory
+    (older versions) is removed afterwards.
+
+    """
+    app_dir = get_app_dir(app_name)
+    if not os.path.isdir(get_release_dir(app_name, release)):
+        raise NameError('Unknown release: {0}'.format(release))
+    tmp_link = os.path.join(app_dir, '.{0}.{1}'.format(CURRENT_LINK, os.getpid()))
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.join(RELEASES_DIR, release), tmp_link)
+    os.rename(tmp_link, get_current_dir(app_name))
+    for name in os.listdir(app_dir):
+        if name in (RELEASES_DIR, CURRENT_LINK) or name.startswith('.'):
+            continue
+        path = os.path.join(app_dir, name)
+        if os.path.islink(path) or not os.path.isdir(path):
+            os.remove(path)
+        else:
+            shutil.rmtree(path)
+    return True
+
+def remove_release(app_name=None, release=None):
+    if release == get_current_release(app_name):
+        raise RuntimeError('Cannot remove the current release')
+    # code is either links into the package cache or a clone -- rmtree
+    # removes links without following them
+    shutil.rmtree(get_release_dir(app_name, release), ignore_errors=True)
+    return True
+
+def prune_releases(app_name=None, keep=None):
+    """
+    Removes all but the ``keep`` newest releases (the current release is
+    always kept)
+
+    Returns the removed releases.
+
+    :keyword keep: Releases to keep (default ``RELEASES_KEEP``)
+
+    """
+    if keep is None:
+        keep = settings.RELEASES_KEEP
+    removed = []
+    for info in get_releases(app_name)[keep:]:
+        if info['current']:
+            continue
+        remove_release(app_name, info['release'])
+        removed.append(info['release'])
+    return removed
+
+def get_previous_release(app_name=None):
+    """
+    Returns the release deployed before the current one (or None)
+
+    """
+    releases = [x['release'] for x in get_releases(app_name)]
+    current = get_current_release(app_name)
+    if current not in releases:
+        return releases[0] if releases else None
+    older = releases[releases.index(current) + 1:]
+    return older[0] if older else None
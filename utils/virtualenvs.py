@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+import errno
+import fcntl
+import glob
+import hashlib
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+import settings
+from utils import releases
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# written once a virtualenv has been built completely
+COMPLETE_MARKER = '.complete'
+
+# VIRTUALENV_CACHE_DIR/<fingerprint> links to the build in use
+# (<fingerprint>.<build>) so a rebuild can be swapped in with a rename
+# (virtualenvs cannot be moved once built)
+LOCK_SUFFIX = 'lock'
+
+def _read_requirements(requirements=None):
+    reqs = []
+    if requirements and os.path.exists(requirements):
+        with open(requirements, 'r') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    reqs.append(line)
+    return reqs
+
+def get_virtualenv_fingerprint(packages=None, requirements=None, runtime=None):
+    """
+    Returns the fingerprint (sha256) of a runtime and dependency set
+
+    Order, comments and blank lines in the requirements file do not change
+    the fingerprint.
+
+    :keyword packages: List of packages
+    :keyword requirements: (optional) Path to requirements.txt file
+    :keyword runtime: (optional) Python runtime
+
+    """
+    deps = sorted(set([x.strip() for x in packages or []] + \
+        _read_requirements(requirements)))
+    data = json.dumps({'runtime': runtime or '', 'dependencies': deps}, sort_keys=True)
+    return hashlib.sha256(data).hexdigest()
+
+def get_virtualenv_path(fingerprint=None):
+    return os.path.join(settings.VIRTUALENV_CACHE_DIR, fingerprint)
+
+def is_virtualenv_complete(fingerprint=None):
+    return os.path.exists(os.path.join(get_virtualenv_path(fingerprint), COMPLETE_MARKER))
+
+def get_virtualenv_build_dir(fingerprint=None):
+    """
+    Returns a new (not yet created) directory to build a virtualenv in
+
+    """
+    return '{0}.{1}'.format(get_virtualenv_path(fingerprint), uuid.uuid4().hex[:8])
+
+def activate_virtualenv_build(fingerprint=None, build_dir=None):
+    """
+    Marks a build complete and makes it the virtualenv of ``fingerprint``
+
+    Applications linked to the fingerprint see either the old or the new
+    build, never a missing or partial one.  The replaced build is kept
+    (until ``prune_virtualenvs``) for processes still running from it.
+    Must be called with the ``virtualenv_lock`` held.
+
+    """
+    with open(os.path.join(build_dir, COMPLETE_MARKER), 'w') as f:
+        f.write(str(time.time()))
+    path = get_virtualenv_path(fingerprint)
+    if os.path.isdir(path) and not os.path.islink(path):
+        # built in place (older versions)
+        os.rename(path, get_virtualenv_build_dir(fingerprint))
+    old_build = os.path.realpath(path) if os.path.islink(path) else None
+    tmp_link = '{0}.{1}.tmp'.format(path, os.getpid())
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(build_dir, tmp_link)
+    os.rename(tmp_link, path)
+    if old_build and os.path.exists(old_build):
+        # unused from now on (for prune_virtualenvs)
+        os.utime(old_build, None)
+    return path
+
+@contextmanager
+def file_lock(path=None):
+    """
+    Holds an exclusive (per node) lock on ``path``
+
+    """
+    lock_dir = os.path.dirname(path)
+    if not os.path.exists(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def virtualenv_lock(fingerprint=None):
+    """
+    Locks a cached virtualenv while it is built or removed
+
+    """
+    return file_lock('{0}.{1}'.format(get_virtualenv_path(fingerprint), LOCK_SUFFIX))
+
+def wheelhouse_lock():
+    """
+    Locks the wheelhouse while wheels are added to it
+
+    """
+    return file_lock(os.path.join(settings.WHEELHOUSE_DIR, '.lock'))
+
+def link_virtualenv(application=None, fingerprint=None):
+    """
+    Points ``VIRTUALENV_BASE_DIR/<application>`` at a cached virtualenv
+
+    The link is replaced with a rename so the application never sees a
+    missing virtualenv.
+
+    """
+    ve_dir = os.path.join(settings.VIRTUALENV_BASE_DIR, application)
+    if not os.path.exists(settings.VIRTUALENV_BASE_DIR):
+        os.makedirs(settings.VIRTUALENV_BASE_DIR)
+    if os.path.isdir(ve_dir) and not os.path.islink(ve_dir):
+        # virtualenv built for the application alone (older versions)
+        shutil.rmtree(ve_dir)
+    if os.path.islink(ve_dir) and os.path.exists(ve_dir):
+        # the virtualenv being left is unused from now on (for
+        # prune_virtualenvs)
+        os.utime(ve_dir, None)
+    os.utime(get_virtualenv_path(fingerprint), None)
+    tmp_link = '{0}.{1}.tmp'.format(ve_dir, os.getpid())
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(get_virtualenv_path(fingerprint), tmp_link)
+    os.rename(tmp_link, ve_dir)
+    return ve_dir
+
+def unlink_virtualenv(application=None):
+    """
+    Removes the virtualenv link (or dir) of an application
+
+    """
+    ve_dir = os.path.join(settings.VIRTUALENV_BASE_DIR, application)
+    if os.path.islink(ve_dir):
+        # unused from now on (for prune_virtualenvs)
+        if os.path.exists(ve_dir):
+            os.utime(os.path.realpath(ve_dir), None)
+        os.remove(ve_dir)
+        return True
+    if os.path.exists(ve_dir):
+        shutil.rmtree(ve_dir)
+        return True
+    return False
+
+def get_virtualenv_refs():
+    """
+    Returns a dict of fingerprint to the applications using it
+
+    """
+    refs = {}
+    if not os.path.exists(settings.VIRTUALENV_BASE_DIR):
+        return refs
+    for application in os.listdir(settings.VIRTUALENV_BASE_DIR):
+        ve_dir = os.path.join(settings.VIRTUALENV_BASE_DIR, application)
+        if os.path.islink(ve_dir):
+            # the fingerprint link, not the build it points to
+            fingerprint = os.path.basename(os.readlink(ve_dir))
+            refs.setdefault(fingerprint, []).append(application)
+    return refs
+
+def _get_release_fingerprints():
+    # virtualenvs kept releases were deployed with (for rollbacks)
+    fingerprints = set()
+    for release_dir in glob.glob(os.path.join(settings.APPLICATION_BASE_DIR, '*', \
+        releases.RELEASES_DIR, '*')):
+        app_name = os.path.basename(os.path.dirname(os.path.dirname(release_dir)))
+        info = releases.get_release_info(app_name, os.path.basename(release_dir))
+        if info.get('fingerprint'):
+            fingerprints.add(info['fingerprint'])
+    return fingerprints
+
+def get_cached_virtualenvs():
+    """
+    Returns the cached virtualenvs as dicts
+
+    """
+    cache_dir = settings.VIRTUALENV_CACHE_DIR
+    if not os.path.exists(cache_dir):
+        return []
+    refs = get_virtualenv_refs()
+    kept = _get_release_fingerprints()
+    envs = []
+    for fingerprint in os.listdir(cache_dir):
+        path = get_virtualenv_path(fingerprint)
+        if '.' in fingerprint or not os.path.isdir(path):
+            continue
+        envs.append({
+            'fingerprint': fingerprint,
+            'path': path,
+            'date': os.path.getmtime(path),
+            'complete': is_virtualenv_complete(fingerprint),
+            'applications': refs.get(fingerprint, []),
+            'released': fingerprint in kept,
+        })
+    return envs
+
+def _get_unused_builds():
+    # builds no fingerprint links to (replaced, failed or in progress)
+    cache_dir = settings.VIRTUALENV_CACHE_DIR
+    names = os.listdir(cache_dir) if os.path.exists(cache_dir) else []
+    used = set(os.path.realpath(get_virtualenv_path(x)) for x in names if '.' not in x)
+    builds = []
+    for name in names:
+        fingerprint, sep, build = name.partition('.')
+        path = os.path.join(cache_dir, name)
+        if not sep or build == LOCK_SUFFIX or not os.path.isdir(path) or \
+            os.path.islink(path) or path in used:
+            continue
+        builds.append((fingerprint, path))
+    return builds
+
+def prune_virtualenvs(ttl=None):
+    """
+    Removes cached virtualenvs no application has used for ``ttl`` seconds
+
+    Unused environments are kept for a while (and as long as a kept release
+    was deployed with them) so a rollback can link them again.  Returns the
+    removed fingerprints.
+
+    :keyword ttl: Seconds to keep unused virtualenvs (default
+        ``VIRTUALENV_CACHE_TTL``)
+
+    """
+    if ttl is None:
+        ttl = settings.VIRTUALENV_CACHE_TTL
+    removed = []
+    for env in get_cached_virtualenvs():
+        if env['applications'] or env['released'] or time.time() - env['date'] < ttl:
+            continue
+        with virtualenv_lock(env['fingerprint']):
+            # linked again while waiting for the lock
+            if env['fingerprint'] in get_virtualenv_refs():
+                continue
+            if os.path.islink(env['path']):
+                build_dir = os.path.realpath(env['path'])
+                os.remove(env['path'])
+                shutil.rmtree(build_dir, ignore_errors=True)
+            else:
+                shutil.rmtree(env['path'], ignore_errors=True)
+        removed.append(env['fingerprint'])
+    for fingerprint, build_dir in _get_unused_builds():
+        if time.time() - os.path.getmtime(build_dir) < ttl:
+            continue
+        with virtualenv_lock(fingerprint):
+            if build_dir != os.path.realpath(get_virtualenv_path(fingerprint)):
+                shutil.rmtree(build_dir, ignore_errors=True)
+    return removed